@@ -0,0 +1,84 @@
+import re
+import unicodedata
+
+# Anything that is not a letter, digit or whitespace is ignored when comparing answers
+PUNCTUATION = re.compile(r'[^\w\s]|_')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(text):
+    """
+    Normalize an answer for comparison: without accents, case, punctuation or repeated whitespace
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    folded = ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+    return WHITESPACE.sub(' ', PUNCTUATION.sub(' ', folded)).strip()
+
+
+def bounded_distance(first, second, limit):
+    """
+    Levenshtein distance between two strings, or limit + 1 if it is greater than limit.
+    Only the diagonal band of width 2 * limit + 1 is computed.
+    """
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    if len(first) > len(second):
+        first, second = second, first
+
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [limit + 1] * (len(second) + 1)
+        if i <= limit:
+            current[0] = i
+        low = max(1, i - limit)
+        high = min(len(second), i + limit)
+        for j in range(low, high + 1):
+            cost = 0 if first_char == second[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+        if min(current[low - 1:high + 1]) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[len(second)], limit + 1)
+
+
+class AnswerMatcher:
+    """
+    Checks the answers to a question, built once when the story is loaded.
+
+    The expected answers (the 'answer' of the question and its alternative 'answers') and the received
+    text are compared without accents, case, punctuation or repeated whitespace. Up to 'max_typos'
+    edits (insertions, deletions or substitutions) are tolerated if the question sets it.
+    """
+    __slots__ = ('answers', 'max_typos')
+
+    def __init__(self, answers, max_typos=0):
+        """
+        :param answers: Accepted answers
+        :param max_typos: Edits tolerated between the received text and an accepted answer
+        """
+        self.answers = frozenset(normalize(answer) for answer in answers if answer and normalize(answer))
+        self.max_typos = max_typos
+
+    @classmethod
+    def from_question(cls, question):
+        """
+        Build the matcher of a question of the history config, or None if it has no answer
+        """
+        answers = [question.get('answer')] + list(question.get('answers', []))
+        answers = [str(answer) for answer in answers if answer is not None]
+        max_typos = int(question.get('max_typos', 0))
+        if max_typos < 0:
+            raise ValueError(f"Invalid max_typos {max_typos} in question {question.get('id')}")
+        matcher = cls(answers, max_typos)
+        return matcher if matcher.answers else None
+
+    def matches(self, text):
+        """
+        Check whether the text is one of the accepted answers
+        """
+        received = normalize(text)
+        if received in self.answers:
+            return True
+        if not self.max_typos:
+            return False
+        return any(bounded_distance(received, answer, self.max_typos) <= self.max_typos for answer in self.answers)
@@ -0,0 +1,74 @@
+import functools
+import logging
+import queue
+import threading
+
+
+class ChatExecutor:
+    """
+    Pool of worker threads running the handlers of different chats concurrently.
+
+    Every chat is assigned to a single worker by its chat_id, so the updates of a chat are still
+    processed strictly in the order they arrived while slow requests of one chat do not stall the rest.
+    Each worker has a bounded queue: when it is full, the dispatcher blocks until there is room,
+    which applies backpressure to the update fetching instead of growing without limit. Updates that
+    can be dropped (e.g. live location edits) are queued without blocking instead.
+    """
+
+    def __init__(self, workers=8, queue_size=100):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+
+    def start(self):
+        for index, tasks in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(tasks,), name=f'chat-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Finish the queued tasks and stop the workers
+        """
+        for tasks in self._queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @staticmethod
+    def _run(tasks):
+        while (task := tasks.get()) is not None:
+            handler, args, kwargs = task
+            try:
+                handler(*args, **kwargs)
+            except Exception:
+                logging.exception(f"Error in handler {handler.__name__}")
+
+    def pending(self):
+        """
+        Number of tasks waiting in the queues of the workers
+        """
+        return sum(tasks.qsize() for tasks in self._queues)
+
+    def submit(self, chat_id, handler, *args, block=True, **kwargs):
+        """
+        Queue a call to handler in the worker of the chat
+
+        :param block: Wait for room in the queue of the worker if it is full. Otherwise the call is not queued
+        :return: Whether the call was queued
+        """
+        try:
+            self._queues[hash(chat_id) % len(self._queues)].put((handler, args, kwargs), block=block)
+            return True
+        except queue.Full:
+            return False
+
+    def ordered(self, handler):
+        """
+        Decorator running a dispatcher handler in the worker of the chat of the update
+        """
+        @functools.wraps(handler)
+        def wrapper(update, context):
+            chat_id = update.effective_chat.id if update.effective_chat else 0
+            self.submit(chat_id, handler, update, context)
+        return wrapper
@@ -0,0 +1,104 @@
+from collections import namedtuple
+
+# Row of the chat_data table
+ChatState = namedtuple('ChatState', ('chat_id', 'story', 'current_step', 'current_question', 'helps_used', 'start_time', 'total_time', 'username'))
+
+COLUMNS = ', '.join(ChatState._fields)
+
+
+class ChatStore:
+    """
+    Access to the chat_data table, with the state of every chat in every story it played.
+
+    Every state transition (moving to a step, answering a question, using a help) is a single UPDATE
+    returning the new row, so the handlers do not need to read the row again afterwards. The statements
+    are prepared once per connection.
+    """
+
+    # Minutes added to the total time for each help used
+    HELP_PENALTY_MINUTES = 5
+
+    STATEMENTS = {
+        'chat_get': ('bigint, varchar',
+                     f"SELECT {COLUMNS} FROM chat_data WHERE chat_id=$1 AND story=$2"),
+        'chat_get_many': ('bigint[], varchar[]',
+                          f"SELECT {COLUMNS} FROM chat_data WHERE (chat_id, story) IN (SELECT * FROM unnest($1, $2))"),
+        'chat_username_exists': ('varchar, varchar',
+                                 "SELECT EXISTS(SELECT 1 FROM chat_data WHERE story=$1 AND username=$2)"),
+        'chat_create': ('bigint, varchar, varchar',
+                        "INSERT INTO chat_data (chat_id, story, current_step, current_question, helps_used, username) "
+                        f"VALUES ($1, $2, 0, 0, 0, $3) RETURNING {COLUMNS}"),
+        'chat_set_question': ('bigint, varchar, int',
+                              f"UPDATE chat_data SET current_question=$3 WHERE chat_id=$1 AND story=$2 RETURNING {COLUMNS}"),
+        'chat_add_help': ('bigint, varchar',
+                          f"UPDATE chat_data SET helps_used=helps_used+1 WHERE chat_id=$1 AND story=$2 RETURNING {COLUMNS}"),
+        # $4: reset the game, $5: start the clock, $6: current time, $7: stop the clock
+        'chat_move_to_step': ('bigint, varchar, int, boolean, boolean, timestamp, boolean',
+                              "UPDATE chat_data SET current_step=$3, current_question=0, "
+                              "helps_used = CASE WHEN $4 THEN 0 ELSE helps_used END, "
+                              "start_time = CASE WHEN $4 THEN NULL WHEN $5 THEN $6 ELSE start_time END, "
+                              "total_time = CASE WHEN $4 THEN NULL "
+                              f"WHEN $7 THEN $6 - start_time + helps_used * interval '{HELP_PENALTY_MINUTES} minutes' "
+                              "ELSE total_time END "
+                              f"WHERE chat_id=$1 AND story=$2 RETURNING {COLUMNS}")
+    }
+
+    def __init__(self, database):
+        self._database = database
+        for name, (types, statement) in self.STATEMENTS.items():
+            database.prepare(name, types, statement)
+
+    def _fetch_state(self, name, *params):
+        with self._database.cursor() as cur:
+            self._database.execute_prepared(cur, name, params)
+            row = cur.fetchone()
+        return ChatState(*row) if row else None
+
+    def get(self, chat_id, story):
+        """
+        Get the state of a chat in a story, or None if it is not registered in it
+        """
+        return self._fetch_state('chat_get', chat_id, story)
+
+    def get_many(self, keys):
+        """
+        Get the state of several chats as a dict by (chat_id, story). Unregistered chats are missing
+
+        :param keys: (chat_id, story) pairs
+        """
+        chat_ids = [chat_id for chat_id, _ in keys]
+        stories = [story for _, story in keys]
+        with self._database.cursor() as cur:
+            self._database.execute_prepared(cur, 'chat_get_many', (chat_ids, stories))
+            return {(row[0], row[1]): ChatState(*row) for row in cur.fetchall()}
+
+    def username_exists(self, story, username):
+        with self._database.cursor() as cur:
+            self._database.execute_prepared(cur, 'chat_username_exists', (story, username))
+            return cur.fetchone()[0]
+
+    def create(self, chat_id, story, username):
+        """
+        Register a chat in a story at the introduction step
+        """
+        return self._fetch_state('chat_create', chat_id, story, username)
+
+    def set_question(self, chat_id, story, question_id):
+        return self._fetch_state('chat_set_question', chat_id, story, question_id)
+
+    def add_help(self, chat_id, story):
+        """
+        Count one more help used by a chat
+        """
+        return self._fetch_state('chat_add_help', chat_id, story)
+
+    def move_to_step(self, chat_id, story, step_id, now, reset=False, start=False, finish=False):
+        """
+        Move a chat to a step of a story with its first question
+
+        :param now: Current time, to start or stop the clock
+        :param reset: Restart the game, clearing the helps and times
+        :param start: Start the clock
+        :param finish: Stop the clock and store the total time, with the penalty of the helps used
+        """
+        return self._fetch_state('chat_move_to_step', chat_id, story, step_id, reset, start, now, finish)
@@ -0,0 +1,294 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    Connection remembering the statements already prepared on it
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Database:
+    """
+    Thread-safe pool of PostgreSQL connections with a unit-of-work per handler invocation.
+
+    Every handler borrows a single connection for its whole execution and runs inside one transaction,
+    which is committed when the handler returns and rolled back if it raises. Connections that were
+    closed by the error or cannot be rolled back are discarded, and connections that stayed idle for a while, or all the
+    idle ones once a connection broke, are checked before being reused until a live one is found, so
+    the pool reconnects transparently after a PostgreSQL restart.
+    The pool is only opened by connect() or the first borrowed connection, so creating the Database
+    does not need PostgreSQL to be available.
+    """
+
+    # Connections idle for longer than this (in seconds) are checked before being handed out
+    IDLE_CHECK_SECONDS = 30
+
+    def __init__(self, minconn, maxconn, on_query=None, **connect_kwargs):
+        """
+        :param minconn: Minimum number of connections kept open
+        :param maxconn: Maximum number of connections
+        :param on_query: Callable receiving every executed query and the seconds it took
+        """
+        if on_query:
+            connect_kwargs['cursor_factory'] = self._timed_cursor(on_query)
+        connect_kwargs['connection_factory'] = PreparedConnection
+        # name -> (parameter types, statement) of the statements prepared on demand in every connection
+        self._statements = {}
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._connect_kwargs = connect_kwargs
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises when it is exhausted, so bound the borrowers to block instead
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._local = threading.local()
+        # id(connection) -> time it was returned to the pool
+        self._last_used = {}
+        # Connection of its own for ping(), so it does not wait for the handlers holding the pooled ones
+        self._ping_conn = None
+        self._ping_lock = threading.Lock()
+
+    @staticmethod
+    def _timed_cursor(on_query):
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    on_query(query, time.perf_counter() - started)
+        return TimedCursor
+
+    def connect(self, timeout=None, delay=0.5, max_delay=5):
+        """
+        Open the pool of connections if it is not open yet, retrying while PostgreSQL is not available
+
+        :param timeout: Seconds to keep retrying before raising the last error, None to try only once
+        :param delay: Seconds to wait before the first retry, doubled in every retry up to max_delay
+        """
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            with self._pool_lock:
+                if self._pool is not None:
+                    return
+                try:
+                    self._pool = ThreadedConnectionPool(self._minconn, self._maxconn, **self._connect_kwargs)
+                    return
+                except psycopg2.OperationalError as e:
+                    if time.monotonic() + delay > deadline:
+                        raise
+                    logging.warning(f'Database not available, retrying in {delay} seconds: {e}')
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def _borrow(self):
+        if self._pool is None:
+            self.connect()
+        self._slots.acquire()
+        try:
+            # Every pooled connection may be broken, e.g. after a PostgreSQL restart, so keep checking them.
+            # Once the idle ones are discarded the pool opens a new connection, which is not checked
+            for _ in range(self._maxconn + 1):
+                conn = self._pool.getconn()
+                idle_since = self._last_used.pop(id(conn), None)
+                if conn.closed or (idle_since is not None and time.monotonic() - idle_since > self.IDLE_CHECK_SECONDS
+                                   and not self._is_alive(conn)):
+                    logging.warning('Discarding broken database connection')
+                    self._pool.putconn(conn, close=True)
+                    self._suspect_idle()
+                    continue
+                return conn
+            raise psycopg2.OperationalError('No live database connection available')
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _suspect_idle(self):
+        """
+        Check the idle connections before reusing them, as they probably broke together with the one discarded
+        """
+        for key in list(self._last_used):
+            self._last_used[key] = float('-inf')
+
+    def _release(self, conn, broken=False):
+        try:
+            broken = broken or bool(conn.closed)
+            if broken:
+                self._suspect_idle()
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed block inside a transaction on a borrowed connection.
+        Nested calls on the same thread join the outer transaction.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._borrow()
+        self._local.conn = conn
+        self._local.state = {}
+        self._local.before_commit = []
+        self._local.after_commit = []
+        broken = False
+        try:
+            yield conn
+            for callback in self._local.before_commit:
+                callback()
+            conn.commit()
+            callbacks = self._local.after_commit
+        except Exception:
+            # Errors such as serialization failures, deadlocks or cancelled queries leave the connection usable,
+            # so it is only discarded if it was closed or cannot even be rolled back
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            self._local.conn = None
+            self._local.state = None
+            self._local.before_commit = []
+            self._local.after_commit = []
+            self._release(conn, broken)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Error in after commit callback: {e}")
+
+    def in_transaction(self):
+        """
+        Check whether the current thread is inside a transaction
+        """
+        return getattr(self._local, 'conn', None) is not None
+
+    def transaction_state(self):
+        """
+        Dict living as long as the current transaction, e.g. to reuse the rows already read in it, or None if there is none
+        """
+        return getattr(self._local, 'state', None) if getattr(self._local, 'conn', None) is not None else None
+
+    def before_commit(self, callback):
+        """
+        Run callback inside the current transaction right before it is committed (or right away if there is none).
+        The transaction is rolled back if it raises
+        """
+        if getattr(self._local, 'conn', None) is None:
+            callback()
+        else:
+            self._local.before_commit.append(callback)
+
+    def after_commit(self, callback):
+        """
+        Run callback once the current transaction is committed (or right away if there is none)
+        """
+        if getattr(self._local, 'conn', None) is None:
+            callback()
+        else:
+            self._local.after_commit.append(callback)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Get a cursor bound to the current transaction (or to a new one if there is none)
+        """
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def prepare(self, name, types, statement):
+        """
+        Register a statement to run with execute_prepared. It is prepared once per connection, the first time it runs
+
+        :param name: Name of the prepared statement
+        :param types: Comma-separated types of the parameters ($1, $2...)
+        :param statement: SQL statement, with $1, $2... as parameters
+        """
+        self._statements[name] = (types, statement)
+
+    def execute_prepared(self, cur, name, params):
+        """
+        Execute a registered statement in the cursor, preparing it first if this connection has not done it yet
+        """
+        conn = cur.connection
+        if name not in conn.prepared:
+            types, statement = self._statements[name]
+            cur.execute(f"PREPARE {name} ({types}) AS {statement}")
+            conn.prepared.add(name)
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+    def unit_of_work(self, handler):
+        """
+        Decorator running a handler inside a single transaction
+        """
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with self.transaction():
+                return handler(*args, **kwargs)
+        return wrapper
+
+    def ping(self, timeout=2):
+        """
+        Check that PostgreSQL answers, e.g. for a readiness probe. It uses a connection outside of the pool,
+        so it neither waits for nor takes a connection of the handlers, and it fails after timeout seconds
+
+        :return: True if PostgreSQL answered, False otherwise
+        """
+        with self._ping_lock:
+            try:
+                if self._ping_conn is None or self._ping_conn.closed:
+                    kwargs = dict(self._connect_kwargs, connect_timeout=max(1, round(timeout)))
+                    kwargs.pop('cursor_factory', None)
+                    self._ping_conn = psycopg2.connect(options=f'-c statement_timeout={round(timeout * 1000)}', **kwargs)
+                    self._ping_conn.autocommit = True
+                with self._ping_conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+                return True
+            except psycopg2.Error as e:
+                logging.warning(f'Database ping failed: {e}')
+                if self._ping_conn is not None:
+                    self._ping_conn.close()
+                    self._ping_conn = None
+                return False
+
+    def close(self):
+        with self._ping_lock:
+            if self._ping_conn is not None:
+                self._ping_conn.close()
+                self._ping_conn = None
+        if self._pool is not None:
+            self._pool.closeall()
@@ -0,0 +1,35 @@
+import hashlib
+import os
+import threading
+
+
+class FileHasher:
+    """
+    SHA-256 of the content of files, shared by the media caches so they key the files the same way.
+    The hash of every file is kept with its mtime and size and only recomputed when they change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> (mtime_ns, size, content hash)
+        self._hashes = {}
+
+    def content_hash(self, path):
+        """
+        Hash of the content of the file, recomputed only when its mtime or size change.
+        Raises FileNotFoundError if the file does not exist.
+        """
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as media_file:
+            for chunk in iter(lambda: media_file.read(1 << 20), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        with self._lock:
+            self._hashes[path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+        return content_hash
@@ -1,4 +1,30 @@
 import math
+import numbers
+from functools import lru_cache
+
+RADIUS = 6371  # km
+
+CARDINAL_DIRECTIONS = [
+    'Norte', 'Nornoreste', 'Noreste', 'Estenoreste',
+    'Este', 'Estesureste', 'Sureste', 'Sursureste',
+    'Sur', 'Sursuroeste', 'Suroeste', 'Oestesuroeste',
+    'Oeste', 'Oestenoroeste', 'Noroeste', 'Nornoroeste'
+]
+
+@lru_cache(maxsize=1024)
+def _coordinate_terms(lat, lon):
+    """
+    Radians, sine and cosine of the latitude and radians of the longitude of a coordinate.
+    Cached, since targets are the same few coordinates over and over
+    """
+    lat_radians = math.radians(lat)
+    return lat_radians, math.radians(lon), math.sin(lat_radians), math.cos(lat_radians)
+
+def _is_single(coords):
+    """
+    Check whether coords is a single (lat, lon) instead of a sequence of them
+    """
+    return len(coords) == 2 and isinstance(coords[0], numbers.Real)
 
 class GeoCalculator:
     @staticmethod
@@ -19,7 +45,7 @@ class GeoCalculator:
         """
         lat1, lon1 = coord1
         lat2, lon2 = coord2
-        radius = 6371  # km
+        radius = RADIUS
 
         dlat = math.radians(lat2 - lat1)
         dlon = math.radians(lon2 - lon1)
@@ -84,15 +110,112 @@ class GeoCalculator:
         cardinal_direction : str
             Cardinal direction in Spanish
         """
-        directions = [
-            'Norte', 'Nornoreste', 'Noreste', 'Estenoreste',
-            'Este', 'Estesureste', 'Sureste', 'Sursureste',
-            'Sur', 'Sursuroeste', 'Suroeste', 'Oestesuroeste',
-            'Oeste', 'Oestenoroeste', 'Noroeste', 'Nornoroeste'
-        ]
-        
         index = round(bearing / 22.5)
         index %= 16
 
-        return directions[index]
+        return CARDINAL_DIRECTIONS[index]
 
+    @staticmethod
+    def calculate_haversine(coord1, coord2):
+        """
+        Calculate the haversine term of the distance between two coordinates, sin²(distance / 2R).
+        It grows with the distance, so it can be compared with haversine_threshold() without the square
+        roots and arctangent of the distance. The terms of the coordinates are cached, as for
+        calculate_navigation
+
+        Parameters
+        ----------
+        coord1 : tuple of float
+            (lat1, lon1)
+        coord2 : tuple of float
+            (lat2, lon2)
+
+        Returns
+        -------
+        haversine : float
+        """
+        lat1, lon1, _, cos_lat1 = _coordinate_terms(*coord1)
+        lat2, lon2, _, cos_lat2 = _coordinate_terms(*coord2)
+        sin_half_dlat = math.sin((lat2 - lat1) / 2)
+        sin_half_dlon = math.sin((lon2 - lon1) / 2)
+        return sin_half_dlat * sin_half_dlat + cos_lat1 * cos_lat2 * sin_half_dlon * sin_half_dlon
+
+    @staticmethod
+    def haversine_threshold(distance):
+        """
+        Haversine term of a distance in kilometers, to compare with calculate_haversine
+        """
+        return math.sin(distance / (2 * RADIUS)) ** 2
+
+    @staticmethod
+    def calculate_navigation(coords, targets):
+        """
+        Calculate the Haversine distances, compass bearings and cardinal directions of many coordinates
+        to their targets in one pass, sharing the trigonometric terms between both formulas. Either side
+        can be a single (lat, lon) to compute one-to-many or many-to-one. The radians, sine and cosine of
+        every coordinate are cached, so fixed targets are only converted once.
+
+        Parameters
+        ----------
+        coords : sequence of (lat, lon) or a single (lat, lon)
+            Origin coordinates
+        targets : sequence of (lat, lon) or a single (lat, lon)
+            Target coordinates, as many as coords unless one of them is single
+
+        Returns
+        -------
+        distances_in_km : list of float
+        compass_bearings : list of int
+            Compass bearings in degrees, from north
+        cardinal_directions : list of str
+            Cardinal directions in Spanish
+        """
+        single_coord, single_target = _is_single(coords), _is_single(targets)
+        if single_coord and single_target:
+            pairs = [(coords, targets)]
+        elif single_coord:
+            pairs = [(coords, target) for target in targets]
+        elif single_target:
+            pairs = [(coord, targets) for coord in coords]
+        else:
+            if len(coords) != len(targets):
+                raise ValueError(f'Got {len(coords)} coordinates for {len(targets)} targets')
+            pairs = zip(coords, targets)
+
+        distances, bearings, cardinals = [], [], []
+        for (lat1, lon1), (lat2, lon2) in pairs:
+            lat1, lon1, sin_lat1, cos_lat1 = _coordinate_terms(lat1, lon1)
+            lat2, lon2, sin_lat2, cos_lat2 = _coordinate_terms(lat2, lon2)
+            dlon = lon2 - lon1
+
+            sin_half_dlat = math.sin((lat2 - lat1) / 2)
+            sin_half_dlon = math.sin(dlon / 2)
+            a = sin_half_dlat * sin_half_dlat + cos_lat1 * cos_lat2 * sin_half_dlon * sin_half_dlon
+            distances.append(RADIUS * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)))
+
+            if (lat1, lon1) == (lat2, lon2):
+                bearing = 0
+            else:
+                y = math.sin(dlon) * cos_lat2
+                x = cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * math.cos(dlon)
+                bearing = round((math.degrees(math.atan2(y, x)) + 360) % 360)
+            bearings.append(bearing)
+            cardinals.append(CARDINAL_DIRECTIONS[round(bearing / 22.5) % 16])
+
+        return distances, bearings, cardinals
+
+    @staticmethod
+    def calculate_distances(coords, targets):
+        """
+        Calculate the Haversine distances of many coordinates to their targets.
+        See calculate_navigation for the parameters
+        """
+        return GeoCalculator.calculate_navigation(coords, targets)[0]
+
+    @staticmethod
+    def calculate_compass_bearings(coords, targets):
+        """
+        Calculate the compass bearings in degrees of many coordinates to their targets.
+        See calculate_navigation for the parameters
+        """
+        return GeoCalculator.calculate_navigation(coords, targets)[1]
@@ -1,20 +1,63 @@
+import functools
+import html
 import logging
-import json
-import psycopg2
 import os
-from datetime import datetime, timedelta, timezone
+import re
+import signal
+import threading
+import time
+from datetime import datetime
 
 from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, TypeHandler
+from ChatExecutor import ChatExecutor
+from ChatStore import ChatStore
+from Database import Database
 from GeoCalculator import GeoCalculator
-
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+from Leaderboard import Leaderboard
+from Geofence import GeofenceEngine
+from LocationCoalescer import LocationCoalescer
+from LocationStore import LocationStore, SharedLocationStore
+from ManagerNotifier import ManagerNotifier
+from MediaCache import MediaCache
+from MediaOptimizer import FINAL_IMAGE, MediaOptimizer, story_media
+from OutboundScheduler import OutboundScheduler
+from RadarCache import RadarCache
+from Metrics import Metrics, MetricsServer
+from ReplicaRouter import ReplicaRouter
+from SchemaMigrations import SchemaMigrations
+from SessionStore import SessionStore, SharedSessionStore
+from StepEventLog import StepEventLog
+from StoryCatalog import StoryCatalog
+from StructuredLogging import parse_levels, setup_logging
+from TelegramRequest import InstrumentedRequest
+from UpdateRecorder import UpdateRecorder
+from WebhookServer import WebhookServer
+
+# Level of the logs, per-logger levels (e.g. to silence the libraries), format ('json' or 'text') and records
+# per second logged for every high-frequency event (e.g. the live location updates)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = parse_levels(os.environ.get('LOG_LEVELS', 'telegram=WARNING,urllib3=WARNING,apscheduler=WARNING'))
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATE = int(os.environ.get('LOG_SAMPLE_RATE', 1))
+
+# File every incoming update is appended to, to replay the traffic later with benchmark/replay.py (disabled if empty)
+UPDATE_RECORDING = os.environ.get('UPDATE_RECORDING', '')
 
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-# Bot instance for isolated messages (without context)
-bot = Bot(BOT_TOKEN)
+# Base URL of the Bot API, to point the bot to a local stand-in (e.g. in load tests)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL') or None
+
+# Directory of the bot, the relative paths of the configuration are relative to it
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
-CONFIG_PATH = 'config/history_metadata.json'
+# Catalog of the stories served by the bot. The first one is played by default and the others are
+# chosen with a deep link (https://t.me/<bot>?start=<story id>)
+STORIES_PATH = os.path.join(APP_DIR, os.environ.get('STORIES_PATH', 'config/stories.json'))
+
+# Stories with the index of their history config, reloaded automatically when the file changes. Loaded on startup
+stories = None
 
 # Radius of distance to accept to the next objective in kilometers during navigation (30 meters)
 LOCATION_PRECISION = 0.01
@@ -23,89 +66,273 @@ HELP_QUERY_URL = 'https://www.google.com/maps/search/?api=1&query={lat},{lon}'
 
 MANAGER_CHAT_ID = 926958805
 
-# Database connection handler
-con = None
-
-# Object containing the message update with the real-time location of the user
-locations = {}
-
-# Flag for name request in progress and temporary name store for verification
-requesting_name = False
-temp_name = None
-
-# Flag for location sharing request in progress
-requesting_location = False
-
-def init_db():
-    db_host = os.environ.get('POSTGRES_HOST')
-    db_port = os.environ.get('POSTGRES_PORT')
-    db_name = os.environ.get('POSTGRES_DB')
-    db_user = os.environ.get('POSTGRES_USER')
-    db_password = os.environ.get('POSTGRES_PASSWORD')
-
-    global conn
-    conn = psycopg2.connect(
-        host=db_host,
-        port=db_port,
-        database=db_name,
-        user=db_user,
-        password=db_password
-    )
-    cur =  conn.cursor()
-
-    # Check if the table name already exists and create it otherwise
-    try:
-        cur.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name='chat_data')")
-        table_exists = cur.fetchone()[0]
+# Entries of the ranking shown to the players and to the manager
+RANKING_SIZE = 10
+MANAGER_RANKING_SIZE = 50
+
+# Number of threads processing updates concurrently (the updates of a chat are always processed in order)
+WORKERS = int(os.environ.get('BOT_WORKERS', 8))
+
+# Maximum number of updates waiting for each worker before the dispatcher blocks
+WORKER_QUEUE_SIZE = int(os.environ.get('BOT_WORKER_QUEUE_SIZE', 100))
+
+# How updates are received: 'polling' or 'webhook'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+
+# Webhook mode: public URL registered in Telegram (not registered if empty, e.g. for local tests),
+# address and path of the embedded server and secret token Telegram must send with every update
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Set to 1 to run the webhook without WEBHOOK_SECRET, accepting updates from anyone who reaches it (local tests only)
+WEBHOOK_ALLOW_NO_SECRET = int(os.environ.get('WEBHOOK_ALLOW_NO_SECRET', 0))
+# Seconds the webhook waits for every update to be handled before answering, 0 to answer right away.
+# Used by benchmark/replay.py to post the next update of a chat only after the previous one was handled
+WEBHOOK_WAIT_HANDLED = float(os.environ.get('WEBHOOK_WAIT_HANDLED', 0))
+
+# Where the sessions and live locations are kept: 'memory' (single replica) or 'postgres' (shared by several replicas)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+
+# Several replicas (webhook mode): webhook URLs of all of them, in the same order everywhere, and position of
+# this one. The updates of every chat are forwarded to the replica owning it
+REPLICA_PEERS = [url.strip() for url in os.environ.get('REPLICA_PEERS', '').split(',') if url.strip()]
+REPLICA_INDEX = int(os.environ.get('REPLICA_INDEX', 0))
+
+# Address of the Prometheus metrics endpoint (disabled if the port is 0)
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+
+# Optimized renditions of the media: directory where they are stored, maximum width and height of
+# the images, JPEG quality and bitrate of the audio
+MEDIA_CACHE_DIR = os.path.join(APP_DIR, os.environ.get('MEDIA_CACHE_DIR', 'media/.optimized'))
+MEDIA_MAX_IMAGE_SIZE = int(os.environ.get('MEDIA_MAX_IMAGE_SIZE', 1280))
+MEDIA_JPEG_QUALITY = int(os.environ.get('MEDIA_JPEG_QUALITY', 82))
+MEDIA_AUDIO_BITRATE = os.environ.get('MEDIA_AUDIO_BITRATE', '48k')
+
+metrics = Metrics()
+handler_seconds = metrics.histogram('bot_handler_duration_seconds', 'Time spent processing an update, by handler', ('handler',))
+handler_errors = metrics.counter('bot_handler_errors_total', 'Handlers that raised an exception, by handler', ('handler',))
+query_seconds = metrics.histogram('bot_db_query_duration_seconds', 'Time spent executing SQL statements, by statement and table', ('query',))
+telegram_seconds = metrics.histogram('bot_telegram_request_duration_seconds', 'Time spent in Bot API calls, by method', ('method',))
+telegram_errors = metrics.counter('bot_telegram_request_errors_total', 'Failed Bot API calls, by method', ('method',))
+telegram_upload_bytes = metrics.histogram('bot_telegram_upload_bytes', 'Size of the files uploaded to Telegram, by method', ('method',),
+                                          buckets=(1e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 5e7))
+location_updates = metrics.counter('bot_location_updates_total', 'Live location updates received')
+location_updates_coalesced = metrics.counter('bot_location_updates_coalesced_total', 'Live location updates superseded by a newer one before being processed')
+location_updates_shed = metrics.counter('bot_location_updates_shed_total', 'Live location updates dropped because of the load')
+geofence_arrivals = metrics.counter('bot_geofence_arrivals_total', 'Arrivals to a target detected from the live location')
+radar_cached = metrics.counter('bot_radar_cached_total', 'Radar presses answered with the reply computed for the same location')
+radar_debounced = metrics.counter('bot_radar_debounced_total', 'Radar presses ignored because they came too soon after the previous one')
+
+def instrumented(handler):
+    """
+    Decorator recording the duration and errors of a handler
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with handler_seconds.time(handler=handler.__name__):
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(handler=handler.__name__)
+                raise
+    return wrapper
+
+QUERY_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|PREPARE|EXECUTE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)', re.IGNORECASE)
+
+def observe_query(query, seconds):
+    """
+    Record the duration of a SQL statement, labelled by its verb and table or prepared statement (e.g. "UPDATE chat_data")
+    """
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    verb = query.split(None, 1)[0].upper() if query.strip() else ''
+    table = QUERY_TABLE.search(query)
+    query_seconds.observe(seconds, query=f'{verb} {table.group(1)}' if table else verb)
+
+def observe_telegram_request(method, seconds, upload_size, failed):
+    telegram_seconds.observe(seconds, method=method)
+    if upload_size:
+        telegram_upload_bytes.observe(upload_size, method=method)
+    if failed:
+        telegram_errors.inc(method=method)
+
+# Messages per second sent in total and to a single chat (after a burst of TELEGRAM_CHAT_BURST messages)
+TELEGRAM_RATE_LIMIT = float(os.environ.get('TELEGRAM_RATE_LIMIT', 30))
+TELEGRAM_CHAT_RATE_LIMIT = float(os.environ.get('TELEGRAM_CHAT_RATE_LIMIT', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 5))
+# Messages that can be sent at once in total, on top of TELEGRAM_RATE_LIMIT
+TELEGRAM_BURST = int(os.environ.get('TELEGRAM_BURST', 1))
+
+# Pacing of the outgoing messages. The manager notifications wait for the messages to the players.
+# The global limit is split between the replicas, each chat is only served by its owner
+outbound = OutboundScheduler(TELEGRAM_RATE_LIMIT / max(len(REPLICA_PEERS), 1), TELEGRAM_CHAT_RATE_LIMIT, TELEGRAM_CHAT_BURST,
+                             low_priority_chats=(MANAGER_CHAT_ID,), burst=TELEGRAM_BURST)
+
+# Bot instance shared by the handlers and the isolated messages (without context), created on startup
+bot = None
+
+# Seconds to wait on startup for the database to be available
+POSTGRES_CONNECT_TIMEOUT = float(os.environ.get('POSTGRES_CONNECT_TIMEOUT', 60))
+# Seconds the readiness probe waits for the database to answer
+POSTGRES_PING_TIMEOUT = float(os.environ.get('POSTGRES_PING_TIMEOUT', 2))
+
+# Pool of database connections, opened on startup (or by the first query)
+db = Database(
+    # Keep every connection open, with its prepared statements
+    int(os.environ.get('POSTGRES_POOL_MIN', WORKERS + 2)),
+    int(os.environ.get('POSTGRES_POOL_MAX', WORKERS + 2)),
+    on_query=observe_query,
+    host=os.environ.get('POSTGRES_HOST'),
+    port=os.environ.get('POSTGRES_PORT'),
+    database=os.environ.get('POSTGRES_DB'),
+    user=os.environ.get('POSTGRES_USER'),
+    password=os.environ.get('POSTGRES_PASSWORD')
+)
+
+# Latest real-time location of every chat
+LOCATION_STORE_SIZE = int(os.environ.get('LOCATION_STORE_SIZE', 5000))
+LOCATION_INACTIVITY_TIMEOUT = int(os.environ.get('LOCATION_INACTIVITY_TIMEOUT', 15*60))
+# Seconds after which a live location update still waiting to be processed is dropped
+LOCATION_MAX_AGE = int(os.environ.get('LOCATION_MAX_AGE', 60))
+# Process only the newest live location edit of every chat (0 to process all of them in order, e.g. in replays)
+LOCATION_COALESCING = int(os.environ.get('LOCATION_COALESCING', 1))
+
+# Readings inside LOCATION_PRECISION needed to detect the arrival from the live location, and worst accepted accuracy in meters
+GEOFENCE_CONFIRMATIONS = int(os.environ.get('GEOFENCE_CONFIRMATIONS', 2))
+GEOFENCE_MAX_ACCURACY = float(os.environ.get('GEOFENCE_MAX_ACCURACY', 50))
+
+# Seconds after a radar press during which new presses of the same chat are ignored
+RADAR_COOLDOWN = float(os.environ.get('RADAR_COOLDOWN', 2))
+
+def create_chat_data(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS chat_data (chat_id BIGINT PRIMARY KEY, current_step INT, current_question INT, helps_used INT, start_time timestamp, total_time interval, username VARCHAR)")
+
+def add_chat_data_story(cur):
+    # Chats registered before several stories were served played the default one
+    cur.execute("SELECT EXISTS(SELECT * FROM information_schema.columns WHERE table_name='chat_data' AND column_name='story')")
+    if not cur.fetchone()[0]:
+        cur.execute("ALTER TABLE chat_data ADD COLUMN story VARCHAR NOT NULL DEFAULT %s", (stories.default.id,))
+        cur.execute("ALTER TABLE chat_data ALTER COLUMN story DROP DEFAULT, DROP CONSTRAINT chat_data_pkey, ADD PRIMARY KEY (chat_id, story)")
+
+def set_chat_data_fillfactor(cur):
+    # Free space in every page lets the updates of the progress of a chat stay in its page without touching the indexes
+    cur.execute("ALTER TABLE chat_data SET (fillfactor = 70)")
+
+# Versions of the database schema. Never change an applied migration, add a new version instead
+MIGRATIONS = [
+    (1, 'create chat_data', create_chat_data),
+    (2, 'create media_cache', MediaCache.create_table),
+    (3, 'create chat_session', SessionStore.create_table),
+    (4, 'add story to chat_data', add_chat_data_story),
+    (5, 'index chat_data by story and total_time', Leaderboard.create_index),
+    (6, 'create chat_location', SharedLocationStore.create_table),
+    (7, 'create chat_event', StepEventLog.create_table),
+    (8, 'leave room for in-place updates in chat_data', set_chat_data_fillfactor),
+]
+
+# State of the chats in every story
+chats = ChatStore(db)
+
+# Every transition of the chats, written behind for split times and funnel analytics
+step_events = StepEventLog(db)
+
+# Telegram file_ids of the media already uploaded, to avoid uploading the same file again
+media_cache = MediaCache(db)
+
+# Smaller renditions of the images and audio, served instead of the originals once generated
+media_optimizer = MediaOptimizer(MEDIA_CACHE_DIR, MEDIA_MAX_IMAGE_SIZE, MEDIA_JPEG_QUALITY, MEDIA_AUDIO_BITRATE)
+
+# Conversation phase of every chat (name or location request in progress), the name pending verification
+# and the story being played, and the latest real-time location of every chat
+if STATE_BACKEND == 'postgres':
+    sessions = SharedSessionStore(db)
+    locations = SharedLocationStore(db, LOCATION_INACTIVITY_TIMEOUT)
+else:
+    sessions = SessionStore(db)
+    locations = LocationStore(LOCATION_STORE_SIZE, LOCATION_INACTIVITY_TIMEOUT)
+metrics.gauge('bot_location_store_size', 'Live locations stored', lambda: len(locations))
+
+# Best total times of every story, updated when the players finish or restart. Created on startup with the stories
+leaderboards = {}
+
+def load_stories():
+    """
+    Load the story catalog and create the leaderboard of every story
+    """
+    global stories
+    stories = StoryCatalog(STORIES_PATH, APP_DIR)
+    # With shared state the other replicas also change the leaderboards, so they are reloaded every 30 seconds
+    for story in stories:
+        leaderboards[story.id] = Leaderboard(db, story.id, MANAGER_RANKING_SIZE, max_age=30 if STATE_BACKEND == 'postgres' else None)
 
-        if not table_exists:
-            cur.execute("CREATE TABLE chat_data (chat_id BIGINT PRIMARY KEY, current_step INT, current_question INT, helps_used INT, start_time timestamp, total_time interval, username VARCHAR)")
-            conn.commit()
-    finally:
-        cur.close()
+def get_config_data(story, step_id):
+    """
+    Get the data corresponding to the input step_id (comparing to the field id in the config file of the story). The index is reloaded when the file changes to allow for configuration changes without having to restart the application
+    """
+    return story.index.get_step(step_id)
 
-init_db()
+def get_last_step(story):
+    """
+    Get the maximum step in the history config file of the story
+    """
+    return story.index.get_last_step()
 
-def get_config_data(step_id):
+def current_story(chat_id):
     """
-    Get the data corresponding to the input step_id (comparing to the field id in the config file. The JSON is read every time to allow for configuration changes without having to restart the application)
-    """    
-    try:
-        with open(CONFIG_PATH, 'r') as history_file:
-            history_data = json.load(history_file)
-            # Find the data corresponding to the current step
-            return next((step_data for step_data in history_data if step_data.get('id') == step_id), None)
-    except FileNotFoundError:
-        logging.error(f"File not found: {CONFIG_PATH}")
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
+    Get the story the chat is playing: the one chosen in its last /start deep link, or the default one
+    """
+    return stories.get(sessions.get(chat_id).story) or stories.default
 
-def get_last_step():
+def get_navigation_target(chat_id):
     """
-    Get the maximum step in the history config file
-    """ 
-    try:
-        with open(CONFIG_PATH, 'r') as history_file:
-            history_data = json.load(history_file)
-            return max(data.get('id') for data in history_data)
-    except FileNotFoundError:
-        logging.error(f"File not found: {CONFIG_PATH}")
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
+    Get the coordinates the chat is navigating to, or None if it is not in a navigation phase (e.g. answering questions)
+    """
+    story = current_story(chat_id)
+    chat = chats.get(chat_id, story.id)
+    if not chat or chat.current_step == 0:
+        return None
+    if story.index.get_question(chat.current_step, chat.current_question):
+        return None
+    current_step_data = get_config_data(story, chat.current_step)
+    return current_step_data and current_step_data.get('next_coordinates')
+
+# Arrival detection from the live location updates, without having to press the radar
+geofences = GeofenceEngine(get_navigation_target, LOCATION_PRECISION,
+                           confirmations=GEOFENCE_CONFIRMATIONS, max_accuracy=GEOFENCE_MAX_ACCURACY)
+
+# Last radar reply of every chat, reused while the location does not change
+radar_cache = RadarCache(RADAR_COOLDOWN, LOCATION_STORE_SIZE)
 
 def start(update: Update, context: CallbackContext):
     """
     This handler sends a menu with the text and inline buttons of the welcome message
     """
     chat_id = update.effective_chat.id
-    notify_manager(chat_id)
+
+    # The deep link payload (/start <story id>) chooses the story to play
+    if context.args:
+        story = stories.get(context.args[0])
+        if not story:
+            context.bot.send_message(chat_id, "No conozco esa aventura. Revisa el enlace que has usado para empezar.")
+            return
+        if story is not current_story(chat_id):
+            sessions.update(chat_id, story=story.id)
+            # The navigation target belongs to the previous story
+            geofences.invalidate(chat_id)
+            radar_cache.invalidate(chat_id)
+    else:
+        story = current_story(chat_id)
 
     # Check that there is not existing data for current user
-    current_chat_data = get_current_chat_data(chat_id)
+    chat = chats.get(chat_id, story.id)
+    notify_manager(chat_id, story.id, chat)
     
-    if current_chat_data:
+    if chat:
         # If the user already existed, resend the initial instructions. Might be useful if they did not start the adventure but the chat got lost. Otherwise, they will not know how to start
-        if(current_chat_data[0] == 0):
+        if(chat.current_step == 0):
             send_next_step(0, update, context)
         return   
 
@@ -115,9 +342,8 @@ def request_name(update: Update, context: CallbackContext):
     """
     This function requests the user to specify their name
     """
-    # Set flag to true to identify the next user message as a 
-    global requesting_name
-    requesting_name= True
+    # Set the phase to identify the next user message as a name
+    sessions.update(update.effective_chat.id, phase=SessionStore.REQUESTING_NAME)
 
     name_request = "Hola, soy GeocacheBot. Mi propósito es guiarte a lo largo de esta aventura intertemporal hasta entontrar el Geocaché final. Si no has llegado aquí intencionalmente, quizás quieras visitar la web de Geocaching.com y aprender en qué consiste este juego. Por favor, no eliminar el código. \n\nAntes de empezar, ¿con qué nombre debo dirigirme a ti? Este nombre se utilizará al final para la tabla de clasificación por tiempos."
     context.bot.send_message(update.effective_chat.id, name_request)
@@ -127,15 +353,10 @@ def verify_name(name: str, update: Update, context: CallbackContext):
     Verify if the introduced name is OK
     """
 
-    global temp_name
-    temp_name = name
+    sessions.update(update.effective_chat.id, pending_name=name)
 
     # Check if the name exists
-    cur =  conn.cursor()
-    cur.execute("SELECT username FROM chat_data WHERE username=%s;",(name,))
-    same_name = cur.fetchone()
-    
-    if same_name:
+    if chats.username_exists(current_story(update.effective_chat.id).id, name):
         context.bot.send_message(update.effective_chat.id, "El nombre ya existe. Por favor, elige otro.")
         return
 
@@ -171,39 +392,25 @@ def register_user(update: Update, context: CallbackContext):
     This function registers a new user after the name is specified, with the chat_id and name identification. 
     After that, it triggers the location request
     """
-    global requesting_name
-    requesting_name = False
-
-    global temp_name
-    cur =  conn.cursor()
     chat_id = update.effective_chat.id
-    cur.execute("INSERT INTO chat_data (chat_id, current_step, current_question, helps_used, username) VALUES (%s,%s,%s,%s,%s);", 
-                (chat_id, 0, 0, 0, temp_name))
-    cur.close()
+    name = sessions.get(chat_id).pending_name
+    sessions.update(chat_id, phase=SessionStore.IDLE, pending_name=None)
 
-    request_location(update, context)
+    chat = chats.create(chat_id, current_story(chat_id).id, name)
+    step_events.record(chat_id, chat.story, StepEventLog.REGISTER, chat.current_step, chat.current_question)
+
+    request_location(update, context, chat.username)
     # send_next_step(0, update, context)
 
-def request_location(update: Update, context: CallbackContext):
+def request_location(update: Update, context: CallbackContext, username: str):
     """
     This function requests the user to share their location with the bot and enable real-time
     """
-    global requesting_location
-    requesting_location = True
-
-    current_chat_data = get_current_chat_data(update.effective_chat.id)
-    username = current_chat_data[3]
+    sessions.update(update.effective_chat.id, phase=SessionStore.REQUESTING_LOCATION)
 
     text = f"De acuerdo, {username}. Para poder ayudaros durante la búsqueda de las localizaciones y determinar que estáis en el lugar correcto, necesito acceso a vuestra ubicación en tiempo real. Como desarrolladores de este caché, nos aseguramos de que la localización solo se ponga a disposición del servidor de Telegram y no sea accesible por ninguna persona o entidad. Si no te sientes cómodo con esto, puedes optar por no continuar. \n\nPara compartir tu ubicación, pulsa en compartir, busca la opción de ubicación y marca la opción de compartir la ubicación en tiempo real (no solo la posición actual). Se te pedirá elegir el tiempo que quieres compartir la ubicación. Te recomiendo elegir 8 horas para que no se interrumpa en mitar del juego. Ten en cuenta que puedes dejar de compartirla en cualquier momento si lo necesitas."
     context.bot.send_message(update.effective_chat.id, text)    
 
-def get_current_chat_data(chat_id):
-    cur = conn.cursor()
-    cur.execute("SELECT current_step, current_question, helps_used, username FROM chat_data WHERE chat_id=%s;",(chat_id,))
-    current_chat_data = cur.fetchone()
-    cur.close()
-    return current_chat_data
-
 def build_buttons_markup(buttons):
     buttons_markup = []
 
@@ -237,8 +444,7 @@ def button_tap(update: Update, context: CallbackContext) -> None:
         return
                 
     # Check if the user is creating the name
-    global requesting_name
-    if requesting_name:
+    if sessions.get(chat_id).phase == SessionStore.REQUESTING_NAME:
         if next_step == 0:
             # User clicked NO
             context.bot.send_message(chat_id, "De acuerdo, introduce el nuevo nombre")
@@ -247,9 +453,10 @@ def button_tap(update: Update, context: CallbackContext) -> None:
             register_user(update, context)
         return
 
-    current_chat_data = get_current_chat_data(chat_id)
-    current_step = current_chat_data[0]
-    current_step_data = get_config_data(current_step)            
+    story = current_story(chat_id)
+    chat = chats.get(chat_id, story.id)
+    current_step = chat.current_step
+    current_step_data = get_config_data(story, current_step)            
 
     # Id of the Help button is -1
     if next_step == -1:
@@ -265,42 +472,41 @@ def button_tap(update: Update, context: CallbackContext) -> None:
             context.bot.send_message(update.effective_chat.id, f'De acuerdo, aquí tienes las coordenadas: {help_link}')
 
             # Add one help to total cout            
-            prev_helps_used = current_chat_data[2]
-
-            cur = conn.cursor()
-            cur.execute("UPDATE chat_data SET helps_used=%s WHERE chat_id=%s",(prev_helps_used+1, chat_id))
-            conn.commit()
-            cur.close()
-            notify_manager(chat_id)
+            chat = chats.add_help(chat_id, story.id)
+            if chat:
+                step_events.record(chat_id, story.id, StepEventLog.HELP, chat.current_step, chat.current_question)
+            notify_manager(chat_id, story.id, chat)
         else: 
             context.bot.send_message(update.effective_chat.id, "Lo siento, no hay ayuda disponible en este momento.")   
     elif next_step == -2:    
         # Button to move from the time travel narration to questions       
-        questions = current_step_data.get('questions')
-        for question in questions:
-            if question['id'] == 0:
-                send_question(update, context, question)
-                break
-
-        # If the code gets here, there are not questions in this step.
-        logging.warning('No question was found for current step.')  
+        if question := story.index.get_question(current_step, 0):
+            send_question(update, context, question)
+        else:
+            logging.warning('No question was found for current step.')  
     else:
         # call the update function to send the next message
         send_next_step(next_step, update, context)
 
 def send_next_step(step_id, update: Update, context: CallbackContext):    
     chat_id = update.effective_chat.id    
+    story = current_story(chat_id)
     
-    current_step_data = get_config_data(step_id)
-
-    # Move to target step and reset current_question to 0        
-    cur = conn.cursor()
-    cur.execute("UPDATE chat_data SET current_step=%s, current_question=%s WHERE chat_id=%s",(step_id, 0, chat_id))
+    current_step_data = get_config_data(story, step_id)
+    geofences.invalidate(chat_id)
+    radar_cache.invalidate(chat_id)
+
+    # Move to target step and reset current_question to 0. Step 0 resets helps, start_time and total_time,
+    # step 1 stores the init time and the last step stores the total time, adding 5 minutes for each used help
+    now = datetime.now()
+    is_last_step = step_id == get_last_step(story)
+    chat = chats.move_to_step(chat_id, story.id, step_id, now, reset=step_id == 0, start=step_id == 1, finish=is_last_step)
+    if chat:
+        step_events.record(chat_id, story.id, StepEventLog.STEP, step_id, 0)
 
     buttons = []
     if step_id == 0:
-        # Reset helps, start_time and total_time
-        cur.execute("UPDATE chat_data SET helps_used=%s, start_time=%s, total_time=%s WHERE chat_id=%s",(0, None, None, chat_id))  
+        db.after_commit(lambda: leaderboards[story.id].on_restart(chat_id))
 
         start_button = {
             "id": 1,
@@ -310,10 +516,6 @@ def send_next_step(step_id, update: Update, context: CallbackContext):
         buttons.append(start_button)
 
     elif step_id == 1:
-        # Player just started. Store init time
-        now = datetime.now()
-        cur.execute("UPDATE chat_data SET start_time=%s WHERE chat_id=%s",(now, chat_id))
-
         reset_button = {
             "id": 1,
             "label": "Reiniciar",
@@ -321,32 +523,25 @@ def send_next_step(step_id, update: Update, context: CallbackContext):
         }
         buttons.append(reset_button)
 
-    elif step_id == get_last_step():
-        end_time = datetime.now()
-        # Get the user start time to calculate elapsed
-        cur.execute("SELECT start_time, helps_used FROM chat_data WHERE chat_id=%s;",(chat_id,))
-        data = cur.fetchone()
+    elif is_last_step:
         # Final time before punishment for using helps
-        elapsed = end_time - data[0]
-        # Total time adding 5 minutes for each used help
-        total_time = elapsed + timedelta(minutes = 5*data[1])
+        elapsed = now - chat.start_time
+        total_time = chat.total_time
 
-        # Write final score to database for the highscore future functionality
-        cur.execute("UPDATE chat_data SET total_time=%s WHERE chat_id=%s",(total_time, chat_id))
+        # Place the final score in the ranking
+        db.after_commit(lambda: leaderboards[story.id].on_finish(chat_id, chat.username, total_time))
 
         # Calculate the total number of seconds
         elapsed_seconds = int(elapsed.total_seconds())
         total_seconds = int(total_time.total_seconds())
 
-        final_report =f"Tu tiempo total ha sido de {elapsed_seconds // 3600} horas y {(elapsed_seconds % 3600) // 60} minutos y has usado {data[1]} ayudas. Por lo tanto, tu tiempo final es de {total_seconds // 3600} horas y {(total_seconds % 3600) // 60} minutos (5 min más por cada ayuda)."
+        final_report =f"Tu tiempo total ha sido de {elapsed_seconds // 3600} horas y {(elapsed_seconds % 3600) // 60} minutos y has usado {chat.helps_used} ayudas. Por lo tanto, tu tiempo final es de {total_seconds // 3600} horas y {(total_seconds % 3600) // 60} minutos ({ChatStore.HELP_PENALTY_MINUTES} min más por cada ayuda)."
 
-        send_media(context, chat_id, 'photo', 'image/gracias.jpg')
+        send_media(context, chat_id, 'photo', story.media_path('image', FINAL_IMAGE))
         context.bot.send_message(update.effective_chat.id, final_report)
 
-    conn.commit()
-    cur.close()   
 
-    notify_manager(chat_id) 
+    notify_manager(chat_id, story.id, chat) 
 
     if not current_step_data:
         # No more steps, the history is done
@@ -358,7 +553,7 @@ def send_next_step(step_id, update: Update, context: CallbackContext):
 
     # If there are questions, add a button to move to the questions after the portal narration
     questions = current_step_data.get('questions')
-    if len(questions) > 0 and step_id != get_last_step() - 1:
+    if len(questions) > 0 and step_id != get_last_step(story) - 1:
         # Do not send the button if we are moving to the last step as there is no jump to the past
         logging.info("Adding button for transition to questions")
         question_transition_button = {
@@ -383,45 +578,72 @@ def send_next_step(step_id, update: Update, context: CallbackContext):
 
     # Send audio if any
     if audio_config := current_step_data.get('audio'):
-        send_media(context, update.effective_chat.id, 'audio', 'audio/' + audio_config)     
+        send_media(context, update.effective_chat.id, 'audio', story.media_path('audio', audio_config))     
     
     # In step 1, navigation should start right away, without having to answer questions
     if step_id == 1:
-        start_navigation(update, context)   
+        start_navigation(update, context, chat)   
 
 def send_media(context, chat_id, type, path):
     """
-    Helper to send a media file to the chat, resilient in case the file does not exist
+    Helper to send a media file to the chat, resilient in case the file does not exist.
+    The file is only uploaded the first time; afterwards it is sent by the file_id Telegram returned for it
 
     :param context: The context of the telegram bot
     :param chat_id: Id of the chat to send the file to
     :param type: Type of file. Can be 'audio' or 'photo'
-    :param path: Relative path to the file to be sent
+    :param path: Path to the file to be sent
     """
-    path = 'media/' + path
+    # The file_id is taken from the sent message, so it is sent once the transaction is committed, like the other messages
+    db.after_commit(lambda: _send_media(context, chat_id, type, path))
+
+def _send_media(context, chat_id, type, path):
     try:
+        # Send the optimized rendition of the file when it is available
+        path = media_optimizer.resolve(path)
+        if file_id := media_cache.get_file_id(path):
+            try:
+                send_media_input(context, chat_id, type, file_id)
+                return
+            except BadRequest as e:
+                # The file_id is not valid anymore (e.g. the bot token changed). Upload the file again
+                logging.warning(f"Cached file_id for {path} rejected: {e}")
+                media_cache.invalidate(path)
+
         with open(path, "rb") as file:
+            message = send_media_input(context, chat_id, type, file)
+
+        if message:
             if(type == 'photo'):
-                context.bot.send_photo(
-                    chat_id = chat_id,
-                    photo = file
-                )
+                # Telegram returns several sizes of the photo, the last one is the original
+                media_cache.store(path, message.photo[-1].file_id)
             elif(type == 'audio'):
-                context.bot.send_audio(
-                    chat_id = chat_id,
-                    audio = file
-                )
+                media_cache.store(path, message.audio.file_id)
     except FileNotFoundError:
         logging.error(f"File not found: {path}")
     except Exception as e:
         logging.error(f"An error occurred: {e}")
 
+def send_media_input(context, chat_id, type, media):
+    """
+    Send a media, either as an open file or as a file_id, and return the resulting message
+    """
+    if(type == 'photo'):
+        return context.bot.send_photo(
+            chat_id = chat_id,
+            photo = media
+        )
+    elif(type == 'audio'):
+        return context.bot.send_audio(
+            chat_id = chat_id,
+            audio = media
+        )
+
 def answer(update: Update, context: CallbackContext) -> None:
     """Process answer."""
 
     # Check if the answer belongs to the name registration
-    global requesting_name
-    if requesting_name:
+    if sessions.get(update.effective_chat.id).phase == SessionStore.REQUESTING_NAME:
         verify_name(update.message.text, update, context)
         return
 
@@ -437,32 +659,27 @@ def answer(update: Update, context: CallbackContext) -> None:
     correct_answer = False
 
     chat_id = update.effective_chat.id
-    current_chat_data = get_current_chat_data(chat_id)
+    story = current_story(chat_id)
+    chat = chats.get(chat_id, story.id)
     current_step = None
-    if current_chat_data:
-        current_step = current_chat_data[0]
+    if chat:
+        current_step = chat.current_step
 
     # If current step is the introduction (0), just give default message
     if current_step == 0 or current_step == None:
         text = "Envía /start o pulsa el botón Inicio para comenzar"        
     else:
         # Intermediate step, check if there is an ongoing question and get the answer from history metadata        
-        current_question = current_chat_data[1]
-
-        # Get current correct answer if any
-        current_answer = None
-        current_step_data = get_config_data(current_step)
-        questions = current_step_data.get('questions')
-        for question in questions:
-            if question['id'] == current_question:
-                current_answer = question.get('answer')
-                break 
-        if current_answer:    
-            if update.message and update.message.text.lower() == current_answer.lower():
+        current_question = chat.current_question
+
+        # Get the matcher of the current answer if any (ignoring accents, case, punctuation and the tolerated typos)
+        if matcher := story.index.get_matcher(current_step, current_question):
+            if update.message and matcher.matches(update.message.text):
                 text = "¡Correcto!"
                 correct_answer = True
             else:
                 text = "¿Estás seguro? Inténtalo de nuevo"
+                step_events.record(chat_id, story.id, StepEventLog.WRONG_ANSWER, current_step, current_question)
         else:
         # No current question exists. Send default message
             text = "Deja de charlar y manos a la obra. ¡Necesitamos tu ayuda para encontrar a Anthony!"
@@ -471,40 +688,41 @@ def answer(update: Update, context: CallbackContext) -> None:
 
     if correct_answer:        
         # Check if there are pending questions
-        next_question = None
-
-        for question in questions:
-            if question['id'] == current_question+1:
-                next_question = question
-                break
-        cur = conn.cursor()
+        next_question = story.index.get_question(current_step, current_question+1)
         # Update current_question in DB       
-        cur.execute("UPDATE chat_data SET current_question=%s WHERE chat_id=%s",(current_question+1, chat_id))
+        chat = chats.set_question(chat_id, story.id, current_question+1)
+        step_events.record(chat_id, story.id, StepEventLog.ANSWER, current_step, current_question+1)
         if next_question:                                        
             send_question(update, context, next_question)
-        elif current_step == get_last_step() - 1:
-            # Move to last step without navigation
-            next_step = current_step + 1
-            cur.execute("UPDATE chat_data SET current_step=%s, current_question=%s WHERE chat_id=%s",(next_step, 0, chat_id))
-            send_next_step(next_step, update, context)
+        elif current_step == get_last_step(story) - 1:
+            # Move to last step without navigation (send_next_step updates current_step and current_question)
+            send_next_step(current_step + 1, update, context)
+            return
         else:
-            start_navigation(update, context)       
-        conn.commit()
-        cur.close()
-        notify_manager(chat_id)
+            start_navigation(update, context, chat)       
+        notify_manager(chat_id, story.id, chat)
 
-def start_navigation(update: Update, context: CallbackContext):
-    # Send message about portal closed and navigation start if there is coordinates
+def start_navigation(update: Update, context: CallbackContext, chat=None):
+    """
+    Send message about portal closed and navigation start if there is coordinates
+
+    :param chat: Current ChatState of the chat, if already known
+    """
     chat_id = update.effective_chat.id
-    current_chat_data = get_current_chat_data(chat_id)
-    if current_chat_data:
-        current_step_data = get_config_data(current_chat_data[0])
+    story = current_story(chat_id)
+    chat = chat or chats.get(chat_id, story.id)
+    if chat:
+        current_step_data = get_config_data(story, chat.current_step)
 
     if image_config:= current_step_data.get('image'):
-        send_media(context, update.effective_chat.id, 'photo', 'image/' + image_config)
+        send_media(context, update.effective_chat.id, 'photo', story.media_path('image', image_config))
 
     # If there is a navigation phase (next_coordinates is not null), include the button to send the location
     if current_step_data.get('next_coordinates'):
+        # Start watching the live location for the arrival to the new target
+        geofences.invalidate(chat_id)
+        radar_cache.invalidate(chat_id)
+
         # Make radar button visible for navigation phase
         keyboard = [[KeyboardButton(text="Radar portatemporal 🧭", request_location=False)]]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
@@ -540,11 +758,10 @@ def location(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
 
     # If location request is in progress
-    global requesting_location
-    if requesting_location:
+    if sessions.get(chat_id).phase == SessionStore.REQUESTING_LOCATION:
         logging.info(f'Requesting location is enabled')
         if update.message and update.message.location and update.message.location.live_period:
-            requesting_location = False
+            sessions.update(chat_id, phase=SessionStore.IDLE)
 
             # Live location correctly shared. Persist current location and start the adventure
             context.bot.send_message(chat_id, "Genial, has completado la configuración. ¡Comencemos!")
@@ -556,35 +773,51 @@ def location(update: Update, context: CallbackContext):
         return
     
     # Automatic location send without the initial request. Process it and update stored value.
-    logging.info(f'edited message: {update.edited_message}')
     if message := update.edited_message:
-        global locations
-        locations[chat_id] = message 
-        logging.info(f'Stored new location: {locations}')
+        locations.put(chat_id, message.location, message.edit_date, message.date)
+        location_updates.inc()
+        logging.info('Stored new location for chat %s', chat_id,
+                     extra={'chat_id': chat_id, 'latitude': message.location.latitude, 'longitude': message.location.longitude, 'sample': 'location'})
+
+        # Detect the arrival to the target without waiting for the radar
+        if geofences.check(chat_id, message.location.latitude, message.location.longitude, message.location.horizontal_accuracy):
+            logging.info('Chat %s reached its target', chat_id, extra={'chat_id': chat_id})
+            geofence_arrivals.inc()
+            on_location_found(update, context)
     else:
         logging.warning('Received a manual location outside the request period. Ignoring...')
 
+@instrumented
 def execute_radar(update: Update, context: CallbackContext):
     """
     Execute the radar, by using the latest available location from the user (shared in real time with the bot).
     Check for proximity to the next target.
     """
-    global locations
     chat_id = update.effective_chat.id
-    logging.info(f'Chat ID: {chat_id}')
+    # Presses right after the previous one are collapsed into it
+    if not radar_cache.press(chat_id):
+        radar_debounced.inc()
+        return
     
     last_location = locations.get(chat_id)
     # Check if there is location stored and if the time since the last location was received to detect stopped auto location
-    if not last_location or (datetime.now(timezone.utc) - last_location.edit_date).total_seconds() > 40:
+    if not last_location or time.time() - last_location.edit_date > 40:
         logging.error(f'No location stored for user {chat_id} or stopped real time location')
         context.bot.send_message(chat_id, "Hay problemas con tu localización en tiempo real. Por favor compártela de nuevo. Si la acabas de compartir, espera 30 segundos para que se estabilice y vuelve a intentarlo.")
         return
 
-    user_coords = (last_location.location.latitude, last_location.location.longitude)
+    # The location did not change since the last press: same reply, without reading the chat again
+    if reply := radar_cache.get(chat_id, last_location.edit_date):
+        radar_cached.inc()
+        update.message.reply_text(reply)
+        return
+
+    user_coords = (last_location.latitude, last_location.longitude)
     
     # Find data from current chat to get the target coordinates
-    current_chat_data = get_current_chat_data(update.effective_chat.id)
-    current_step_data = get_config_data(current_chat_data[0])
+    story = current_story(chat_id)
+    chat = chats.get(chat_id, story.id)
+    current_step_data = get_config_data(story, chat.current_step)
 
     if not current_step_data:
         logging.error(f'No data for current step for user {chat_id}')
@@ -592,25 +825,31 @@ def execute_radar(update: Update, context: CallbackContext):
         
     next_coordinates = current_step_data.get('next_coordinates')
     if not next_coordinates:
-        update.message.reply_text(f'No hay ningún objetivo activo.',
-                                reply_markup=None)
+        reply = 'No hay ningún objetivo activo.'
+        radar_cache.put(chat_id, last_location.edit_date, reply)
+        update.message.reply_text(reply, reply_markup=None)
         return            
 
-    distance = GeoCalculator.calculate_distance(user_coords, tuple(next_coordinates))
-    logging.info(f"Distance: {distance} kilometers")
+    (distance,), (bearing,), (bearing_name,) = GeoCalculator.calculate_navigation(user_coords, next_coordinates)
+    logging.info('Radar of chat %s: %.3f kilometers to the target', chat_id, distance,
+                 extra={'chat_id': chat_id, 'distance_km': distance, 'sample': 'radar'})
     if distance <= LOCATION_PRECISION:
-        on_location_found(update, context)
+        on_location_found(update, context, chat)
     else:
-        bearing = GeoCalculator.calculate_compass_bearing(user_coords, next_coordinates)
-        bearing_name = GeoCalculator.convert_bearing_to_cardinal(bearing)
-        update.message.reply_text(f'El objetivo se encuentra a {round(distance*1000)} metros en dirección {bearing_name} ({bearing}° respecto del Norte).')
+        reply = f'El objetivo se encuentra a {round(distance*1000)} metros en dirección {bearing_name} ({bearing}° respecto del Norte).'
+        radar_cache.put(chat_id, last_location.edit_date, reply)
+        update.message.reply_text(reply)
 
-def on_location_found(update: Update, context: CallbackContext):     
+def on_location_found(update: Update, context: CallbackContext, chat=None):     
     # Find data from current chat to get the target coordinates
     chat_id = update.effective_chat.id
-    current_chat_data = get_current_chat_data(chat_id)
-    current_step = current_chat_data[0]
-    current_step_data = get_config_data(current_step)    
+    story = current_story(chat_id)
+    chat = chat or chats.get(chat_id, story.id)
+    current_step = chat.current_step
+    current_step_data = get_config_data(story, current_step)    
+    # The target is reached, do not detect it again from the live location
+    geofences.disarm(chat_id)
+    radar_cache.invalidate(chat_id)
     
     # Remove radar button
     context.bot.send_message(
@@ -621,7 +860,7 @@ def on_location_found(update: Update, context: CallbackContext):
 
     next_step = current_step + 1
 
-    if next_step == get_last_step() - 1:
+    if next_step == get_last_step(story) - 1:
         send_next_step(next_step, update, context)
         return
     if not current_step_data:
@@ -644,53 +883,271 @@ def on_location_found(update: Update, context: CallbackContext):
         reply_markup=build_buttons_markup(button)
     )  
 
-def notify_manager(chat_id: int):
+def format_duration(duration):
+    total_seconds = int(duration.total_seconds())
+    return f'{total_seconds // 3600} h {(total_seconds % 3600) // 60:02d} min'
+
+def ranking(update: Update, context: CallbackContext):
     """
-    Notify manager about update for a user (new game, move to another step, etc)
+    This handler sends the best total times of the story being played and the position of the player. The manager gets a longer list with the chat ids
     """
-    # Check if user is new (if there is data for the chat)
-    chat_data = get_current_chat_data(chat_id)
+    chat_id = update.effective_chat.id
+    is_manager = chat_id == MANAGER_CHAT_ID
+    story = current_story(chat_id)
+    leaderboard = leaderboards[story.id]
+    top = leaderboard.top(MANAGER_RANKING_SIZE if is_manager else RANKING_SIZE)
 
-    if chat_data:
-        if chat_data[0] == get_last_step():
-            text = f'<b>Finish</b> for chat <code>{chat_id}</code> (user <code>{chat_data[3]}</code>)'
-        else:
-            text = (f'<b>Update</b> for chat <code>{chat_id}</code> (user <code>{chat_data[3]}</code>):'
-                    f'\n<b>Step:</b> <code>{chat_data[0]}</code>'
-                    f'\n<b>Question:</b> <code>{chat_data[1]}</code>'
-                    f'\n<b>Helps used:</b> <code>{chat_data[2]}</code>')
+    if not top:
+        context.bot.send_message(chat_id, "Todavía nadie ha terminado la aventura.")
+        return
+
+    lines = [f'<b>Clasificación: {html.escape(story.title)}</b>']
+    for position, (total_time, entry_chat_id, username) in enumerate(top, 1):
+        line = f'{position}. {html.escape(username or "?")} - {format_duration(total_time)}'
+        if is_manager:
+            line += f' (<code>{entry_chat_id}</code>)'
+        lines.append(line)
+
+    if is_manager:
+        lines.append(f'\n<b>Finishers:</b> <code>{leaderboard.count()}</code>')
+    elif own_position := leaderboard.rank(chat_id):
+        lines.append(f'\nTu posición: {own_position}')
     else:
-        text = f'<b>New user:</b> <code>{chat_id}</code>'
+        lines.append('\nTodavía no has terminado la aventura.')
 
-    bot.send_message(
-        MANAGER_CHAT_ID,
-        text,
-        parse_mode=ParseMode.HTML
+    context.bot.send_message(chat_id, '\n'.join(lines), parse_mode=ParseMode.HTML)
+
+def notify_manager(chat_id: int, story_id: str, chat=None):
+    """
+    Notify manager about update for a user in a story (new game, move to another step, etc).
+    The notification is queued once the current transaction is committed and sent in the background
+
+    :param chat: ChatState of the chat after the update, to avoid reading it again (None to read it when sending)
+    """
+    db.after_commit(lambda: manager_notifier.notify((chat_id, story_id), chat))
+
+def describe_chats(pending):
+    """
+    Build the manager notification text with the current state of each chat
+
+    :param pending: dict of (chat_id, story id) -> ChatState, or None if the state has to be read
+    """
+    chats_data = {key: chat for key, chat in pending.items() if chat}
+    if missing := [key for key, chat in pending.items() if not chat]:
+        chats_data.update(chats.get_many(missing))
+
+    texts = []
+    for chat_id, story_id in pending:
+        # Check if user is new (if there is data for the chat)
+        chat_data = chats_data.get((chat_id, story_id))
+        story = stories.get(story_id)
+
+        if chat_data:
+            if story and chat_data.current_step == get_last_step(story):
+                text = f'<b>Finish</b> for chat <code>{chat_id}</code> (user <code>{chat_data.username}</code>, story <code>{story_id}</code>)'
+            else:
+                text = (f'<b>Update</b> for chat <code>{chat_id}</code> (user <code>{chat_data.username}</code>):'
+                        f'\n<b>Story:</b> <code>{story_id}</code>'
+                        f'\n<b>Step:</b> <code>{chat_data.current_step}</code>'
+                        f'\n<b>Question:</b> <code>{chat_data.current_question}</code>'
+                        f'\n<b>Helps used:</b> <code>{chat_data.helps_used}</code>')
+        else:
+            text = f'<b>New user:</b> <code>{chat_id}</code> (story <code>{story_id}</code>)'
+        texts.append(text)
+
+    return texts
+
+# Notifications to the manager, coalesced and sent in the background. Created on startup with the bot
+manager_notifier = None
+
+# Set once the warm-up is done, to report the bot as ready
+warmed_up = threading.Event()
+
+def send_after_commit(send):
+    """
+    Defer a message sent inside a handler until its transaction is committed, so the handler does not keep
+    its database connection and row locks while the message waits for the rate limits
+
+    :return: False if there is no transaction and the message has to be sent right away
+    """
+    if not db.in_transaction():
+        return False
+    db.after_commit(send)
+    return True
+
+def init_bot():
+    """
+    Create the bot, with room in its connection pool for every worker, and the manager notifications sent through it
+    """
+    global bot, manager_notifier
+    bot = Bot(BOT_TOKEN, base_url=TELEGRAM_API_URL,
+              request=InstrumentedRequest(observe_telegram_request, con_pool_size=max(WORKERS, 4) + 4, scheduler=outbound,
+                                          defer=send_after_commit))
+    manager_notifier = ManagerNotifier(bot, MANAGER_CHAT_ID, describe_chats)
+
+def warm_up():
+    """
+    Connect to the database (waiting for it to be available), apply the pending migrations and load
+    what the first updates need, so they are not slowed down by it
+    """
+    started = time.perf_counter()
+    load_stories()
+    db.connect(timeout=POSTGRES_CONNECT_TIMEOUT)
+    applied = SchemaMigrations(db, MIGRATIONS).migrate()
+
+    media_paths = []
+    for story in stories:
+        for path in story_media(story.index.path, story.media_dir):
+            try:
+                media_paths.append(media_optimizer.resolve(path))
+            except FileNotFoundError:
+                logging.error(f"File not found: {path}")
+    media_cache.prime(media_paths)
+    for leaderboard in leaderboards.values():
+        leaderboard.top()
+
+    warmed_up.set()
+    logging.info(f'Warm-up done in {time.perf_counter() - started:.2f} seconds ({applied} migrations applied)')
+
+def is_database_ready():
+    """
+    Check that the database answers, for the readiness probe. It does not use the pool of the handlers,
+    so a replica whose connections are all busy is still reported as ready
+    """
+    return db.ping(timeout=POSTGRES_PING_TIMEOUT)
+
+def create_webhook_server(updater: Updater):
+    """
+    Create the embedded webhook server. It answers the health probe during the warm-up and queues the
+    updates received until the dispatcher starts
+    """
+    if not WEBHOOK_SECRET:
+        if not WEBHOOK_ALLOW_NO_SECRET:
+            raise ValueError('BOT_MODE=webhook requires WEBHOOK_SECRET, otherwise anyone reaching the server can post forged updates. '
+                             'Set WEBHOOK_ALLOW_NO_SECRET=1 to run without it in local tests')
+        logging.warning('WEBHOOK_SECRET is not set: the webhook accepts updates from anyone who reaches it')
+
+    dispatcher = updater.dispatcher
+    return WebhookServer(
+        updater.bot,
+        dispatcher.update_queue,
+        WEBHOOK_LISTEN,
+        WEBHOOK_PORT,
+        WEBHOOK_PATH,
+        WEBHOOK_SECRET,
+        is_ready=lambda: warmed_up.is_set() and dispatcher.running and is_database_ready(),
+        router=ReplicaRouter(REPLICA_PEERS, REPLICA_INDEX, WEBHOOK_SECRET) if len(REPLICA_PEERS) > 1 else None,
+        wait_handled=WEBHOOK_WAIT_HANDLED
     )
+
+def run_webhook(updater: Updater, webhook: WebhookServer):
+    """
+    Process the updates pushed by Telegram to the webhook server until the process is stopped
+    """
+    dispatcher = updater.dispatcher
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(WEBHOOK_URL, api_kwargs={'secret_token': WEBHOOK_SECRET} if WEBHOOK_SECRET else None)
+        logging.info(f'Webhook registered in {WEBHOOK_URL}')
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda *args: stop_event.set())
+    stop_event.wait()
+
+    webhook.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()
+
 def main() -> None:
-    updater = Updater(BOT_TOKEN)
+    log_listener = setup_logging(LOG_LEVEL, LOG_LEVELS, LOG_FORMAT == 'json', LOG_SAMPLE_RATE)
+    init_bot()
+    updater = Updater(bot=bot)
 
     # Get the dispatcher to register handlers
     # Then, we register each handler and the conditions the update must meet to trigger it
     dispatcher = updater.dispatcher
 
+    # Handlers run in a pool of workers, keeping the order of the updates of each chat.
+    # Every handler runs inside a single database transaction
+    executor = ChatExecutor(WORKERS, WORKER_QUEUE_SIZE)
+    metrics.gauge('bot_pending_updates', 'Updates waiting for a worker', executor.pending)
+    def handler(callback):
+        return executor.ordered(instrumented(db.unit_of_work(callback)))
+
+    # Record every update before any handler can stop it
+    recorder = None
+    if UPDATE_RECORDING:
+        recorder = UpdateRecorder(UPDATE_RECORDING)
+        dispatcher.add_handler(TypeHandler(Update, recorder.record), group=-2)
+
+    # Live location edits skip the rest of the handlers. Only the newest one of every chat is processed,
+    # and they are dropped instead of making the dispatcher wait when the workers are overloaded
+    if LOCATION_COALESCING:
+        location_edits = LocationCoalescer(executor, instrumented(db.unit_of_work(location)), LOCATION_MAX_AGE,
+                                           on_coalesced=location_updates_coalesced.inc, on_shed=location_updates_shed.inc)
+        dispatcher.add_handler(MessageHandler(Filters.update.edited_message & Filters.location, location_edits.handle), group=-1)
+
     # Register commands
-    dispatcher.add_handler(CommandHandler('start', start))    
+    dispatcher.add_handler(CommandHandler('start', handler(start)))    
+    dispatcher.add_handler(CommandHandler('ranking', handler(ranking)))
 
     # Register handler for location sharing
-    dispatcher.add_handler(MessageHandler(Filters.location, location))
+    dispatcher.add_handler(MessageHandler(Filters.location, handler(location)))
 
     # Register handler for inline buttons
-    dispatcher.add_handler(CallbackQueryHandler(button_tap))
+    dispatcher.add_handler(CallbackQueryHandler(handler(button_tap)))
 
     # on non command i.e message - echo the message on Telegram
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, answer))
-
-    # Start the Bot
-    updater.start_polling()
-
-    # Run the bot until you press Ctrl-C
-    updater.idle()
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handler(answer)))
+
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics, METRICS_LISTEN, METRICS_PORT)
+        metrics_server.start()
+
+    # Listen for the webhook right away so the health probe answers while warming up
+    webhook = None
+    if BOT_MODE == 'webhook':
+        webhook = create_webhook_server(updater)
+        if WEBHOOK_WAIT_HANDLED:
+            # Queued in the worker of the chat after the handlers of the update, so it runs once they are done.
+            # Updates stopped by an earlier group (e.g. coalesced live locations) are answered after the timeout
+            dispatcher.add_handler(TypeHandler(Update, executor.ordered(lambda update, context: webhook.handled(update.update_id))), group=1)
+        webhook.start()
+
+    warm_up()
+
+    # Start writing the conversation state behind to the database
+    sessions.start()
+    step_events.start()
+    manager_notifier.start()
+    media_optimizer.start(path for story in stories for path in story_media(story.index.path, story.media_dir))
+    executor.start()
+    if recorder:
+        recorder.start()
+
+    if len(REPLICA_PEERS) > 1 and (BOT_MODE != 'webhook' or STATE_BACKEND != 'postgres'):
+        logging.warning('Several replicas need BOT_MODE=webhook and STATE_BACKEND=postgres to share the chats')
+
+    # Start the Bot and run it until you press Ctrl-C
+    if webhook:
+        run_webhook(updater, webhook)
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    executor.stop()
+    if recorder:
+        recorder.stop()
+    manager_notifier.stop()
+    step_events.stop()
+    sessions.stop()
+    if metrics_server:
+        metrics_server.stop()
+    log_listener.stop()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
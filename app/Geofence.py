@@ -0,0 +1,141 @@
+import math
+import threading
+from collections import OrderedDict
+
+from GeoCalculator import RADIUS, GeoCalculator
+
+# Kilometers per degree of latitude
+KM_PER_DEGREE = RADIUS * math.pi / 180
+
+
+class GeofenceTarget:
+    """
+    Target of a geofence with its radii precomputed as thresholds of the haversine term.
+
+    Checking a position only needs the haversine term of GeoCalculator, whose trigonometric terms of the
+    target are cached, and positions far away are discarded with a bounding box before any trigonometry.
+    """
+    __slots__ = ('coordinates', 'enter_threshold', 'exit_threshold', 'max_dlat', 'max_dlon')
+
+    def __init__(self, coordinates, enter_radius, exit_radius):
+        """
+        :param coordinates: (lat, lon) of the target
+        :param enter_radius: Distance in kilometers below which the target is reached
+        :param exit_radius: Distance in kilometers above which the player is considered away from the target
+        """
+        self.coordinates = tuple(coordinates)
+        self.enter_threshold = GeoCalculator.haversine_threshold(enter_radius)
+        self.exit_threshold = GeoCalculator.haversine_threshold(exit_radius)
+        # Degrees around the target outside of which the player is surely beyond the exit radius
+        self.max_dlat = exit_radius / KM_PER_DEGREE
+        self.max_dlon = self.max_dlat / max(math.cos(math.radians(coordinates[0])), 1e-6)
+
+    def haversine(self, latitude, longitude):
+        """
+        Haversine term of the distance from (latitude, longitude) to the target, or None if it is
+        clearly beyond the exit radius
+        """
+        if abs(latitude - self.coordinates[0]) > self.max_dlat or abs(longitude - self.coordinates[1]) > self.max_dlon:
+            return None
+        return GeoCalculator.calculate_haversine((latitude, longitude), self.coordinates)
+
+
+class GeofenceState:
+    """
+    Geofence of a chat: its active target and the readings seen inside it
+    """
+    __slots__ = ('target', 'inside_count')
+
+    def __init__(self, target):
+        self.target = target
+        self.inside_count = 0
+
+
+class GeofenceEngine:
+    """
+    Detects when a chat reaches its active target from its live-location updates.
+
+    The target of every chat is loaded once through the given loader and cached until it is
+    invalidated, so evaluating a location update is done in memory. A target is reached after a few
+    consecutive readings inside the enter radius; readings between the enter and the exit radius
+    keep the count (hysteresis), so GPS jitter around the border neither fires the arrival twice nor
+    resets the progress. Once fired, the geofence stays disarmed until the target is invalidated.
+    """
+
+    def __init__(self, load_target, radius, exit_factor=1.5, confirmations=2, max_accuracy=None, max_entries=5000):
+        """
+        :param load_target: Callable returning the (lat, lon) of the active target of a chat, or None if there is none
+        :param radius: Distance in kilometers to the target to consider it reached
+        :param exit_factor: Factor of the radius beyond which the readings inside are forgotten
+        :param confirmations: Consecutive readings inside the radius needed to fire the arrival
+        :param max_accuracy: Readings with a horizontal accuracy worse than this (in meters) are ignored
+        :param max_entries: Maximum number of chats whose geofence is kept in memory
+        """
+        self._load_target = load_target
+        self._radius = radius
+        self._exit_radius = radius * exit_factor
+        self._confirmations = confirmations
+        self._max_accuracy = max_accuracy
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # chat_id -> GeofenceState, from the least to the most recently used
+        self._states = OrderedDict()
+
+    def _get_state(self, chat_id):
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state:
+                self._states.move_to_end(chat_id)
+                return state
+
+        coordinates = self._load_target(chat_id)
+        state = GeofenceState(GeofenceTarget(coordinates, self._radius, self._exit_radius) if coordinates else None)
+        with self._lock:
+            self._states[chat_id] = state
+            while len(self._states) > self._max_entries:
+                self._states.popitem(last=False)
+        return state
+
+    def check(self, chat_id, latitude, longitude, accuracy=None):
+        """
+        Evaluate a new location of a chat against its active target
+
+        :return: True if the chat has just reached its target
+        """
+        if self._max_accuracy and accuracy and accuracy > self._max_accuracy:
+            return False
+
+        state = self._get_state(chat_id)
+        target = state.target
+        if not target:
+            return False
+
+        haversine = target.haversine(latitude, longitude)
+        if haversine is None or haversine > target.exit_threshold:
+            state.inside_count = 0
+            return False
+        if haversine > target.enter_threshold:
+            return False
+
+        state.inside_count += 1
+        if state.inside_count < self._confirmations:
+            return False
+
+        # Disarm until the next target is set
+        state.target = None
+        return True
+
+    def disarm(self, chat_id):
+        """
+        Stop watching the current target of a chat, e.g. when it was reached by other means
+        """
+        with self._lock:
+            self._states[chat_id] = GeofenceState(None)
+            self._states.move_to_end(chat_id)
+
+    def invalidate(self, chat_id):
+        """
+        Forget the cached target of a chat, so it is loaded again on its next location update
+        """
+        with self._lock:
+            self._states.pop(chat_id, None)
@@ -0,0 +1,109 @@
+import threading
+import time
+from bisect import insort
+
+
+class Leaderboard:
+    """
+    Ranking of the players that finished a story, by total time.
+
+    The best times are kept in memory and updated incrementally when a player finishes or restarts,
+    so the top is never re-sorted on request. The position of a player outside of the top is counted
+    through an ordered index on total_time, without scanning the whole table.
+    """
+
+    def __init__(self, database, story, size=50, max_age=None):
+        """
+        :param database: Database with the chat_data table
+        :param story: Id of the story ranked
+        :param size: Number of best times kept in memory
+        :param max_age: Seconds after which the best times are loaded again, to see the changes made by other
+                        replicas of the bot. None to keep them until they are invalidated
+        """
+        self._database = database
+        self._story = story
+        self._size = size
+        self._max_age = max_age
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        # Sorted list of (total_time, chat_id, username), or None until loaded
+        self._top = None
+
+    @staticmethod
+    def create_index(cur):
+        cur.execute("DROP INDEX IF EXISTS chat_data_total_time_idx")
+        cur.execute("CREATE INDEX IF NOT EXISTS chat_data_story_total_time_idx ON chat_data (story, total_time, chat_id) WHERE total_time IS NOT NULL")
+
+    def _load(self):
+        """
+        Load the best times the first time they are needed (or after an invalidation). Called with the lock held
+        """
+        if self._top is not None and (self._max_age is None or time.monotonic() - self._loaded_at < self._max_age):
+            return
+        self._loaded_at = time.monotonic()
+        with self._database.cursor() as cur:
+            cur.execute("SELECT total_time, chat_id, username FROM chat_data WHERE story=%s AND total_time IS NOT NULL "
+                        "ORDER BY total_time, chat_id LIMIT %s;", (self._story, self._size))
+            self._top = [tuple(row) for row in cur.fetchall()]
+
+    def top(self, limit=None):
+        """
+        Get the best (total_time, chat_id, username) entries, from the best to the worst
+        """
+        with self._lock:
+            self._load()
+            return self._top[:limit or self._size]
+
+    def rank(self, chat_id):
+        """
+        Get the position (starting at 1) of a chat in the ranking, or None if it has not finished
+        """
+        with self._lock:
+            self._load()
+            for position, (_, entry_chat_id, _) in enumerate(self._top, 1):
+                if entry_chat_id == chat_id:
+                    return position
+
+        with self._database.cursor() as cur:
+            cur.execute("SELECT total_time FROM chat_data WHERE chat_id=%s AND story=%s;", (chat_id, self._story))
+            row = cur.fetchone()
+            if not row or row[0] is None:
+                return None
+            cur.execute("SELECT count(*) FROM chat_data WHERE story=%s AND total_time IS NOT NULL AND (total_time, chat_id) < (%s, %s);",
+                        (self._story, row[0], chat_id))
+            return cur.fetchone()[0] + 1
+
+    def count(self):
+        """
+        Get the number of players that finished
+        """
+        with self._database.cursor() as cur:
+            cur.execute("SELECT count(*) FROM chat_data WHERE story=%s AND total_time IS NOT NULL;", (self._story,))
+            return cur.fetchone()[0]
+
+    def on_finish(self, chat_id, username, total_time):
+        """
+        Place the new time of a chat in the top. To be called once the finish is committed
+        """
+        with self._lock:
+            if self._top is None:
+                return
+            # When the top is not full it holds every finisher, otherwise the entries below it are unknown
+            complete = len(self._top) < self._size
+            entry = (total_time, chat_id, username)
+            top = [current for current in self._top if current[1] != chat_id]
+            if complete or (top and entry < top[-1]):
+                insort(top, entry)
+                self._top = top[:self._size]
+            elif len(top) < len(self._top):
+                # The chat left the top, load it again when needed
+                self._top = None
+
+    def on_restart(self, chat_id):
+        """
+        Remove the time of a chat that restarted the adventure. To be called once the restart is committed
+        """
+        with self._lock:
+            if self._top is not None and any(entry[1] == chat_id for entry in self._top):
+                # The next best time is unknown, load the top again when needed
+                self._top = None
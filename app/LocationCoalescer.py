@@ -0,0 +1,67 @@
+import threading
+import time
+
+from telegram.ext import DispatcherHandlerStop
+
+
+class LocationCoalescer:
+    """
+    Fast path for the live location edits.
+
+    Every phone sharing its live location sends an edit every few seconds, and only the newest position
+    of each chat matters. The edits are caught before the rest of the handlers and kept by chat, with a
+    single task per chat queued in its worker: when the task runs it processes the newest edit, so the
+    superseded ones are dropped without running the handler. Queuing an edit never blocks: when the
+    queue of the worker is full, or the edit is too old by the time it runs, it is dropped. Under load
+    the location stream is therefore shed first, while the updates sent by the players wait for room.
+    """
+
+    def __init__(self, executor, handler, max_age=60, on_coalesced=None, on_shed=None):
+        """
+        :param executor: ChatExecutor running the handlers
+        :param handler: Handler processing a live location edit
+        :param max_age: Seconds after which an edit that was not processed yet is dropped
+        :param on_coalesced: Callable called when an edit is superseded by a newer one before being processed
+        :param on_shed: Callable called when an edit is dropped because of the load
+        """
+        self._executor = executor
+        self._handler = handler
+        self._max_age = max_age
+        self._on_coalesced = on_coalesced or (lambda: None)
+        self._on_shed = on_shed or (lambda: None)
+        self._lock = threading.Lock()
+        # chat_id -> (update, context) of the newest edit not processed yet
+        self._latest = {}
+
+    def handle(self, update, context):
+        """
+        Dispatcher handler taking the live location edits out of the normal handler chain
+        """
+        self.offer(update.effective_chat.id, update, context)
+        raise DispatcherHandlerStop()
+
+    def offer(self, chat_id, update, context):
+        """
+        Queue a live location edit of a chat, replacing the one waiting to be processed, if any
+        """
+        with self._lock:
+            scheduled = chat_id in self._latest
+            self._latest[chat_id] = (update, context)
+        if scheduled:
+            self._on_coalesced()
+            return
+
+        if not self._executor.submit(chat_id, self._process, chat_id, block=False):
+            with self._lock:
+                self._latest.pop(chat_id, None)
+            self._on_shed()
+
+    def _process(self, chat_id):
+        with self._lock:
+            update, context = self._latest.pop(chat_id)
+
+        message = update.edited_message
+        if self._max_age and message.edit_date and time.time() - message.edit_date.timestamp() > self._max_age:
+            self._on_shed()
+            return
+        self._handler(update, context)
@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LiveLocation:
+    """
+    Last known live location of a chat
+    """
+    __slots__ = ('latitude', 'longitude', 'accuracy', 'edit_date', 'expires_at')
+
+    def __init__(self, latitude, longitude, accuracy, edit_date, expires_at):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.accuracy = accuracy
+        # Timestamps in seconds since the epoch
+        self.edit_date = edit_date
+        self.expires_at = expires_at
+
+
+class LocationStore:
+    """
+    Bounded store of the latest live location of every chat.
+
+    Only the coordinates, accuracy and edit timestamp are kept. Entries expire when the live period
+    of the location ends or when no update was received for a while, and the least recently updated
+    entries are evicted when the store is full, so memory stays flat however many groups have played.
+    """
+
+    def __init__(self, max_entries=5000, inactivity_timeout=15*60):
+        """
+        :param max_entries: Maximum number of locations stored
+        :param inactivity_timeout: Seconds without updates after which a location is discarded
+        """
+        self._max_entries = max_entries
+        self._inactivity_timeout = inactivity_timeout
+        self._lock = threading.Lock()
+        # chat_id -> LiveLocation, from the least to the most recently updated
+        self._locations = OrderedDict()
+
+    def __len__(self):
+        return len(self._locations)
+
+    def _record(self, location, edit_date, start_date):
+        edit_timestamp = edit_date.timestamp()
+        expires_at = edit_timestamp + self._inactivity_timeout
+        if start_date and location.live_period:
+            expires_at = min(expires_at, start_date.timestamp() + location.live_period)
+        return LiveLocation(location.latitude, location.longitude, location.horizontal_accuracy, edit_timestamp, expires_at)
+
+    def put(self, chat_id, location, edit_date, start_date=None):
+        """
+        Store the live location of a chat
+
+        :param chat_id: Id of the chat
+        :param location: telegram.Location received
+        :param edit_date: Datetime of the location update
+        :param start_date: Datetime when the live location was shared, to expire it at the end of its live period
+        """
+        record = self._record(location, edit_date, start_date)
+        with self._lock:
+            self._locations[chat_id] = record
+            self._locations.move_to_end(chat_id)
+            self._evict()
+
+    def get(self, chat_id):
+        """
+        Get the live location of a chat, or None if there is none or it expired
+        """
+        with self._lock:
+            record = self._locations.get(chat_id)
+            if record and record.expires_at < time.time():
+                del self._locations[chat_id]
+                return None
+            return record
+
+    def _evict(self):
+        """
+        Remove the expired and exceeding entries, starting from the least recently updated. Called with the lock held
+        """
+        now = time.time()
+        while self._locations:
+            chat_id, record = next(iter(self._locations.items()))
+            if len(self._locations) <= self._max_entries and record.expires_at >= now:
+                break
+            del self._locations[chat_id]
+
+
+class SharedLocationStore(LocationStore):
+    """
+    Store of the latest live location of every chat kept in the chat_location table, so the radar of a
+    chat can be served by any replica of the bot and the locations survive restarts.
+
+    The table is unlogged: writing the location updates is cheap, and losing them in a database crash
+    only means waiting for the next update. Expired entries are deleted periodically.
+    """
+
+    # Seconds between two deletions of the expired entries
+    PURGE_INTERVAL = 60
+
+    def __init__(self, database, inactivity_timeout=15*60):
+        """
+        :param database: Database with the chat_location table
+        :param inactivity_timeout: Seconds without updates after which a location is discarded
+        """
+        super().__init__(inactivity_timeout=inactivity_timeout)
+        self._database = database
+        self._last_purge = 0
+
+    @staticmethod
+    def create_table(cur):
+        cur.execute("CREATE UNLOGGED TABLE IF NOT EXISTS chat_location (chat_id BIGINT PRIMARY KEY, latitude DOUBLE PRECISION NOT NULL, "
+                    "longitude DOUBLE PRECISION NOT NULL, accuracy REAL, edit_date DOUBLE PRECISION NOT NULL, expires_at DOUBLE PRECISION NOT NULL)")
+
+    def __len__(self):
+        with self._database.cursor() as cur:
+            cur.execute("SELECT count(*) FROM chat_location WHERE expires_at >= %s;", (time.time(),))
+            return cur.fetchone()[0]
+
+    def put(self, chat_id, location, edit_date, start_date=None):
+        record = self._record(location, edit_date, start_date)
+        with self._database.cursor() as cur:
+            # Updates of the same chat handled by different replicas might be stored out of order
+            cur.execute("INSERT INTO chat_location (chat_id, latitude, longitude, accuracy, edit_date, expires_at) VALUES (%s,%s,%s,%s,%s,%s) "
+                        "ON CONFLICT (chat_id) DO UPDATE SET latitude=EXCLUDED.latitude, longitude=EXCLUDED.longitude, accuracy=EXCLUDED.accuracy, "
+                        "edit_date=EXCLUDED.edit_date, expires_at=EXCLUDED.expires_at WHERE chat_location.edit_date <= EXCLUDED.edit_date;",
+                        (chat_id, record.latitude, record.longitude, record.accuracy, record.edit_date, record.expires_at))
+
+            now = time.monotonic()
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                self._last_purge = now
+                cur.execute("DELETE FROM chat_location WHERE expires_at < %s;", (time.time(),))
+
+    def get(self, chat_id):
+        with self._database.cursor() as cur:
+            cur.execute("SELECT latitude, longitude, accuracy, edit_date, expires_at FROM chat_location WHERE chat_id=%s AND expires_at >= %s;",
+                        (chat_id, time.time()))
+            row = cur.fetchone()
+        return LiveLocation(*row) if row else None
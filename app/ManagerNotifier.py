@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+
+from telegram import ParseMode
+from telegram.error import RetryAfter, TelegramError
+
+
+class ManagerNotifier:
+    """
+    Background pipeline sending the manager notifications out of the players' request path.
+
+    Notifications are queued by chat and coalesced during a short window, so only the latest state of
+    each chat is reported. When several chats changed in the same window they are merged into a single
+    digest message, and messages are paced to respect the Telegram limits for a single chat.
+    """
+
+    # Maximum length of a Telegram message
+    MAX_MESSAGE_LENGTH = 4096
+
+    def __init__(self, bot, manager_chat_id, describe_chats, window=2.0, min_interval=1.0):
+        """
+        :param bot: Bot used to send the notifications
+        :param manager_chat_id: Id of the chat of the manager
+        :param describe_chats: Callable returning the notification text for each chat of the given dict of
+                               key -> state (None if it has to be read), in the order of the dict
+        :param window: Seconds to wait for more changes before sending the pending notifications
+        :param min_interval: Minimum seconds between two messages sent to the manager
+        """
+        self._bot = bot
+        self._manager_chat_id = manager_chat_id
+        self._describe_chats = describe_chats
+        self._window = window
+        self._min_interval = min_interval
+        self._lock = threading.Lock()
+        # key -> latest known state of the chats with pending notifications, in the order they changed
+        self._pending = {}
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._last_sent = 0
+        self._thread = None
+
+    def notify(self, key, state=None):
+        """
+        Queue a notification about the current state of a chat
+
+        :param key: Identifier of the chat notified, e.g. (chat_id, story id). Notifications with the same key are coalesced
+        :param state: State of the chat, if known, to report it without reading it again
+        """
+        with self._lock:
+            self._pending[key] = state
+        self._wakeup.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='manager-notifier', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Send the pending notifications and stop the background thread
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait()
+            # Give other changes the chance to be coalesced in the same message
+            if not self._stopping:
+                time.sleep(self._window)
+            self._wakeup.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return
+
+        try:
+            texts = self._describe_chats(pending)
+        except Exception as e:
+            logging.error(f"Could not build the notification for chats {list(pending)}: {e}")
+            return
+
+        for message in self._build_messages(texts):
+            self._send(message)
+
+    def _build_messages(self, texts):
+        """
+        Merge the notifications into as few messages as possible
+        """
+        if len(texts) == 1:
+            return texts
+
+        messages = []
+        current = f'<b>Digest</b> ({len(texts)} chats)'
+        for text in texts:
+            if len(current) + len(text) + 2 > self.MAX_MESSAGE_LENGTH:
+                messages.append(current)
+                current = text
+            else:
+                current += '\n\n' + text
+        messages.append(current)
+        return messages
+
+    def _send(self, text):
+        while True:
+            wait = self._last_sent + self._min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self._bot.send_message(self._manager_chat_id, text, parse_mode=ParseMode.HTML)
+                self._last_sent = time.monotonic()
+                return
+            except RetryAfter as e:
+                logging.warning(f"Manager notifications throttled, retrying in {e.retry_after} seconds")
+                time.sleep(e.retry_after)
+            except TelegramError as e:
+                logging.error(f"Could not notify the manager: {e}")
+                self._last_sent = time.monotonic()
+                return
@@ -0,0 +1,85 @@
+import threading
+
+from FileHasher import FileHasher
+
+
+class MediaCache:
+    """
+    Cache of the Telegram file_id returned for every uploaded media file.
+
+    Once a file has been uploaded, Telegram can resend it by its file_id, so the file only has to be
+    uploaded once. Entries are keyed by path and content hash and persisted in the media_cache table,
+    so they survive restarts and are invalidated as soon as the file changes.
+    """
+
+    def __init__(self, database):
+        """
+        :param database: Database used to persist the file_ids
+        """
+        self._database = database
+        self._lock = threading.Lock()
+        self._hasher = FileHasher()
+        # path -> (content hash, file_id)
+        self._file_ids = None
+
+    @staticmethod
+    def create_table(cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS media_cache (path VARCHAR PRIMARY KEY, content_hash VARCHAR NOT NULL, file_id VARCHAR NOT NULL)")
+
+    def _load(self):
+        """
+        Load the persisted file_ids the first time they are needed
+        """
+        with self._lock:
+            if self._file_ids is not None:
+                return
+            with self._database.cursor() as cur:
+                cur.execute("SELECT path, content_hash, file_id FROM media_cache;")
+                self._file_ids = {path: (content_hash, file_id) for path, content_hash, file_id in cur.fetchall()}
+
+    def prime(self, paths):
+        """
+        Load the persisted file_ids and hash the given files ahead of their first send. Missing files are skipped
+        """
+        self._load()
+        for path in paths:
+            try:
+                self._hasher.content_hash(path)
+            except FileNotFoundError:
+                pass
+
+    def get_file_id(self, path):
+        """
+        Get the file_id of a previously uploaded file, or None if it was never uploaded or it changed since then.
+        Raises FileNotFoundError if the file does not exist.
+        """
+        content_hash = self._hasher.content_hash(path)
+        self._load()
+        cached = self._file_ids.get(path)
+        if cached and cached[0] == content_hash:
+            return cached[1]
+        return None
+
+    def store(self, path, file_id):
+        """
+        Store the file_id returned by Telegram after uploading the file in path
+        """
+        content_hash = self._hasher.content_hash(path)
+        self._load()
+        self._file_ids[path] = (content_hash, file_id)
+
+        with self._database.cursor() as cur:
+            cur.execute("INSERT INTO media_cache (path, content_hash, file_id) VALUES (%s,%s,%s) "
+                        "ON CONFLICT (path) DO UPDATE SET content_hash=EXCLUDED.content_hash, file_id=EXCLUDED.file_id;",
+                        (path, content_hash, file_id))
+
+    def invalidate(self, path):
+        """
+        Forget the file_id of a file, e.g. when Telegram no longer accepts it
+        """
+        self._load()
+        if self._file_ids.pop(path, None) is None:
+            return
+
+        with self._database.cursor() as cur:
+            cur.execute("DELETE FROM media_cache WHERE path=%s;", (path,))
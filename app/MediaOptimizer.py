@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+from FileHasher import FileHasher
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Image sent to every chat that finishes a story, besides the media of the steps
+FINAL_IMAGE = 'gracias.jpg'
+
+
+class MediaOptimizer:
+    """
+    Smaller renditions of the media sent to the players.
+
+    Images are scaled down to the size Telegram shows them at and re-encoded as JPEG, and audio is
+    re-encoded as mono AAC at a bitrate suited to speech. The renditions are stored in a cache directory
+    named after the hash of the original content, so they are generated once (at startup in the
+    background, or offline before building the image) and regenerated only when the original changes.
+    Until its rendition exists, or if it would not be smaller, the original file is served.
+    """
+
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+    AUDIO_EXTENSIONS = ('.m4a', '.mp3', '.ogg', '.wav')
+
+    def __init__(self, cache_dir='media/.optimized', max_image_size=1280, jpeg_quality=82, audio_bitrate='48k'):
+        """
+        :param cache_dir: Directory where the renditions are stored
+        :param max_image_size: Maximum width and height of the images in pixels
+        :param jpeg_quality: Quality of the re-encoded images, from 1 to 95
+        :param audio_bitrate: Bitrate of the re-encoded audio, as understood by ffmpeg
+        """
+        self._cache_dir = cache_dir
+        self._max_image_size = max_image_size
+        self._jpeg_quality = jpeg_quality
+        self._audio_bitrate = audio_bitrate
+        self._ffmpeg = shutil.which('ffmpeg')
+        self._hasher = FileHasher()
+
+    def _rendition_path(self, path, content_hash):
+        name = os.path.splitext(os.path.basename(path))[0]
+        extension = '.jpg' if path.lower().endswith(self.IMAGE_EXTENSIONS) else '.m4a'
+        # The settings are part of the key so changing them produces new renditions
+        settings = f'{self._max_image_size}-{self._jpeg_quality}-{self._audio_bitrate}'
+        key = hashlib.sha256(f'{content_hash}-{settings}'.encode()).hexdigest()[:16]
+        return os.path.join(self._cache_dir, f'{key}-{name}{extension}')
+
+    def _encode_image(self, path, output):
+        if Image is None:
+            logging.info(f"Pillow is not installed, serving {path} unchanged")
+            return False
+        with Image.open(path) as image:
+            image.thumbnail((self._max_image_size, self._max_image_size), Image.LANCZOS)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # JPEG has no transparency, flatten the image over a white background
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(output, 'JPEG', quality=self._jpeg_quality, optimize=True, progressive=True)
+        return True
+
+    def _encode_audio(self, path, output):
+        if not self._ffmpeg:
+            logging.warning(f"ffmpeg is not installed, serving {path} unchanged")
+            return False
+        subprocess.run([self._ffmpeg, '-loglevel', 'error', '-y', '-i', path, '-vn', '-ac', '1',
+                        '-c:a', 'aac', '-b:a', self._audio_bitrate, '-f', 'mp4', output],
+                       check=True, stdin=subprocess.DEVNULL)
+        return True
+
+    def _generate(self, path):
+        """
+        Generate the rendition of a file if it does not exist yet
+        """
+        rendition = self._rendition_path(path, self._hasher.content_hash(path))
+        # The .skip marker records the files whose rendition would not be smaller than the original
+        if os.path.exists(rendition) or os.path.exists(rendition + '.skip'):
+            return
+
+        lower_path = path.lower()
+        if lower_path.endswith(self.IMAGE_EXTENSIONS):
+            encode = self._encode_image
+        elif lower_path.endswith(self.AUDIO_EXTENSIONS):
+            encode = self._encode_audio
+        else:
+            return
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        # Write to a temporary file first so a rendition is never served half written
+        temporary = f'{rendition}.{os.getpid()}.tmp'
+        try:
+            if not encode(path, temporary):
+                return
+            if os.path.getsize(temporary) >= os.path.getsize(path):
+                open(rendition + '.skip', 'w').close()
+                logging.info(f"Optimizing {path} does not reduce its size, serving it unchanged")
+                return
+            os.replace(temporary, rendition)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+        logging.info(f"Optimized {path}: {os.path.getsize(path)} -> {os.path.getsize(rendition)} bytes")
+
+    def optimize(self, paths):
+        """
+        Generate the renditions of the given files. Errors are logged and the originals are kept
+        """
+        for path in paths:
+            try:
+                self._generate(path)
+            except FileNotFoundError:
+                logging.error(f"File not found: {path}")
+            except Exception as e:
+                logging.error(f"Could not optimize {path}: {e}")
+
+    def start(self, paths):
+        """
+        Generate the renditions of the given files in a background thread
+        """
+        threading.Thread(target=self.optimize, args=(list(paths),), name='media-optimizer', daemon=True).start()
+
+    def resolve(self, path):
+        """
+        Get the path of the file to serve instead of path: its rendition if it has been generated, or path itself.
+        Raises FileNotFoundError if the file does not exist.
+        """
+        rendition = self._rendition_path(path, self._hasher.content_hash(path))
+        return rendition if os.path.exists(rendition) else path
+
+
+def story_media(history_path, media_dir='media'):
+    """
+    Get the paths of every media file referenced in a history config file, and of the final image
+    """
+    with open(history_path) as history_file:
+        history_data = json.load(history_file)
+
+    paths = []
+    for step_data in history_data:
+        if image := step_data.get('image'):
+            paths.append(os.path.join(media_dir, 'image', image))
+        if audio := step_data.get('audio'):
+            paths.append(os.path.join(media_dir, 'audio', audio))
+    paths.append(os.path.join(media_dir, 'image', FINAL_IMAGE))
+    return paths
+
+
+if __name__ == '__main__':
+    # Generate the renditions offline, e.g. before building the Docker image:
+    # python MediaOptimizer.py [config/history_metadata.json]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    MediaOptimizer().optimize(story_media(sys.argv[1] if len(sys.argv) > 1 else 'config/history_metadata.json'))
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from itertools import count
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+
+class ChatPacer:
+    """
+    Token bucket of a chat and the sequence its current burst of messages belongs to
+    """
+    __slots__ = ('tokens', 'updated', 'paused_until', 'ticket', 'last_sent')
+
+    def __init__(self, tokens, now, ticket):
+        self.tokens = tokens
+        self.updated = now
+        self.paused_until = 0
+        self.ticket = ticket
+        self.last_sent = now
+
+
+class OutboundScheduler:
+    """
+    Paces the messages sent to Telegram to respect its rate limits.
+
+    Every message takes a token from a global bucket (about 30 messages per second for a bot) and from
+    the bucket of its chat, blocking the sender until both are available. When several senders wait,
+    the tokens go first to the higher priority ones and then to the chats whose burst of messages
+    started first, so the messages of a step are sent together instead of interleaved with the first
+    message of every other group. The messages of a chat keep their order because each chat is served
+    by a single worker. Calls throttled with RetryAfter or failed by a network error are retried.
+    """
+
+    # Priorities, the lower the sooner
+    NORMAL = 0
+    LOW = 1
+
+    # Seconds without messages after which the next message of a chat starts a new sequence
+    SEQUENCE_GAP = 1.0
+    # Seconds after which the pacer of an idle chat is discarded
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=5, max_retries=3, backoff=0.5, low_priority_chats=(), burst=1):
+        """
+        :param rate: Messages per second sent in total
+        :param chat_rate: Messages per second sent to a single chat once its burst is consumed
+        :param chat_burst: Messages that can be sent to a chat at once
+        :param max_retries: Times a failed call is retried before raising the error
+        :param backoff: Seconds waited before the first retry after a network error, doubled in every retry
+        :param low_priority_chats: Chat ids whose messages wait for the rest (e.g. the manager notifications)
+        :param burst: Messages that can be sent at once in total. The bucket holds no more, so no second
+                      goes over rate + burst messages, including the first one
+        """
+        self._rate = rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._low_priority_chats = set(low_priority_chats)
+        self._condition = threading.Condition()
+        self._burst = min(burst, rate)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        # chat_id -> ChatPacer
+        self._chats = {}
+        # (priority, ticket, order, chat_id) of the senders waiting for a token
+        self._waiters = []
+        self._tickets = count()
+        self._last_cleanup = self._updated
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _pacer(self, chat_id, now):
+        pacer = self._chats.get(chat_id)
+        if pacer is None:
+            pacer = self._chats[chat_id] = ChatPacer(self._chat_burst, now, next(self._tickets))
+        else:
+            pacer.tokens = min(self._chat_burst, pacer.tokens + (now - pacer.updated) * self._chat_rate)
+            pacer.updated = now
+        return pacer
+
+    def _chat_wait(self, pacer, now):
+        """
+        Seconds until the chat can send its next message
+        """
+        return max(pacer.paused_until - now, (1 - pacer.tokens) / self._chat_rate, 0)
+
+    def _cleanup(self, now):
+        if now - self._last_cleanup < self.IDLE_TIMEOUT:
+            return
+        waiting = {waiter[3] for waiter in self._waiters}
+        for chat_id in [chat_id for chat_id, pacer in self._chats.items()
+                        if chat_id not in waiting and now - pacer.last_sent > self.IDLE_TIMEOUT]:
+            del self._chats[chat_id]
+        self._last_cleanup = now
+
+    def acquire(self, chat_id):
+        """
+        Block until a message can be sent to the chat
+        """
+        with self._condition:
+            now = time.monotonic()
+            priority = self.LOW if chat_id in self._low_priority_chats else self.NORMAL
+            pacer = self._pacer(chat_id, now)
+            if now - pacer.last_sent > self.SEQUENCE_GAP:
+                pacer.ticket = next(self._tickets)
+            waiter = (priority, pacer.ticket, next(self._tickets), chat_id)
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    pacer = self._pacer(chat_id, now)
+                    chat_wait = self._chat_wait(pacer, now)
+                    # The best waiter whose chat can send right now gets the next global token
+                    ready = [other for other in self._waiters if self._chat_wait(self._pacer(other[3], now), now) <= 0]
+                    if chat_wait <= 0 and min(ready) == waiter and self._tokens >= 1:
+                        self._tokens -= 1
+                        pacer.tokens -= 1
+                        pacer.last_sent = now
+                        self._cleanup(now)
+                        return
+                    global_wait = (1 - self._tokens) / self._rate if self._tokens < 1 else 0
+                    # When only waiting for better senders, they wake us up when they are done
+                    self._condition.wait(max(chat_wait, global_wait) or 0.05)
+            finally:
+                self._waiters.remove(waiter)
+                self._condition.notify_all()
+
+    def _pause(self, chat_id, seconds):
+        with self._condition:
+            pacer = self._pacer(chat_id, time.monotonic())
+            pacer.paused_until = max(pacer.paused_until, time.monotonic() + seconds)
+
+    def send(self, chat_id, call):
+        """
+        Run call (sending a message to the chat) when the rate limits allow it, retrying it if it is
+        throttled or fails because of the network
+        """
+        for attempt in range(self._max_retries + 1):
+            self.acquire(chat_id)
+            try:
+                return call()
+            except RetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                logging.warning(f"Throttled sending to chat {chat_id}, retrying in {e.retry_after} seconds")
+                self._pause(chat_id, e.retry_after)
+            except TimedOut:
+                # The message might have been delivered, do not send it twice
+                raise
+            except BadRequest:
+                # Rejected by Telegram (e.g. an expired file_id or an unmodified message), it would fail again
+                raise
+            except NetworkError as e:
+                if attempt == self._max_retries:
+                    raise
+                logging.warning(f"Network error sending to chat {chat_id}, retrying: {e}")
+                time.sleep(self._backoff * 2 ** attempt)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RadarEntry:
+    """
+    Last radar press of a chat and the reply computed for its location
+    """
+    __slots__ = ('pressed_at', 'edit_date', 'reply')
+
+    def __init__(self, pressed_at):
+        self.pressed_at = pressed_at
+        # Edit timestamp of the location the reply was computed for, None if there is no reply
+        self.edit_date = None
+        self.reply = None
+
+
+class RadarCache:
+    """
+    Last radar reply of every chat, with a cool-down between presses.
+
+    Players press the radar repeatedly while the live location has not changed, so the reply is kept
+    with the edit timestamp of the location it was computed for and reused until a new location
+    arrives, without reading the chat or computing the distance again. The reply only depends on the
+    location and the target, so it is invalidated whenever the chat moves to another step. Presses
+    arriving before the cool-down since the last answered one are collapsed into it.
+    """
+
+    def __init__(self, cooldown=2.0, max_entries=5000):
+        """
+        :param cooldown: Seconds after an answered press during which new presses are ignored
+        :param max_entries: Maximum number of chats kept, the least recently pressed are evicted
+        """
+        self._cooldown = cooldown
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # chat_id -> RadarEntry, from the least to the most recently pressed
+        self._entries = OrderedDict()
+
+    def press(self, chat_id):
+        """
+        Register a press of the radar
+
+        :return: False if the press has to be ignored because it came too soon after the previous one
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                entry = self._entries[chat_id] = RadarEntry(now)
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+                return True
+            if now - entry.pressed_at < self._cooldown:
+                return False
+            entry.pressed_at = now
+            self._entries.move_to_end(chat_id)
+            return True
+
+    def get(self, chat_id, edit_date):
+        """
+        Get the reply computed for the location with the given edit timestamp, or None if there is none
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry and entry.edit_date == edit_date:
+                return entry.reply
+            return None
+
+    def put(self, chat_id, edit_date, reply):
+        """
+        Store the reply computed for the location with the given edit timestamp
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry:
+                entry.edit_date = edit_date
+                entry.reply = reply
+
+    def invalidate(self, chat_id):
+        """
+        Forget the reply of a chat, e.g. because its target changed. The cool-down is kept
+        """
+        with self._lock:
+            if entry := self._entries.get(chat_id):
+                entry.edit_date = None
+                entry.reply = None
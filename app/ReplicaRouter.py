@@ -0,0 +1,58 @@
+import logging
+import urllib.request
+
+
+class ReplicaRouter:
+    """
+    Routes the updates received by any replica of the bot to the replica owning their chat.
+
+    Every chat is owned by a single replica, chosen from its chat_id, so the updates of a chat keep
+    being processed in order by the same workers and its in-memory state (e.g. the geofence readings)
+    stays in one place. Updates of chats owned by other replicas are forwarded to them; if the owner
+    does not answer, the update is processed locally, as the sessions and locations are shared.
+    """
+
+    # Header marking the forwarded updates, which are never forwarded again
+    FORWARDED_HEADER = 'X-Bot-Replica-Forwarded'
+
+    def __init__(self, peers, index, secret_token=None, timeout=5):
+        """
+        :param peers: Webhook URLs of all the replicas, in the same order in all of them
+        :param index: Position of this replica in peers
+        :param secret_token: Secret token of the webhook, sent with the forwarded updates
+        :param timeout: Seconds to wait for the owner to accept an update
+        """
+        if not 0 <= index < len(peers):
+            raise ValueError(f'Replica index {index} out of range for {len(peers)} replicas')
+        self._peers = list(peers)
+        self._index = index
+        self._secret_token = secret_token
+        self._timeout = timeout
+
+    def owner(self, chat_id):
+        """
+        Get the position of the replica owning a chat
+        """
+        return chat_id % len(self._peers)
+
+    def forward(self, chat_id, body):
+        """
+        Forward an update to the replica owning its chat
+
+        :param body: Update as received, in JSON
+        :return: True if it was accepted by another replica, False if it has to be processed locally
+        """
+        owner = self.owner(chat_id)
+        if owner == self._index:
+            return False
+
+        headers = {'Content-Type': 'application/json', self.FORWARDED_HEADER: '1'}
+        if self._secret_token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self._secret_token
+        request = urllib.request.Request(self._peers[owner], data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                return response.status == 200
+        except Exception as e:
+            logging.warning(f'Could not forward the update of chat {chat_id} to replica {owner}, processing it locally: {e}')
+            return False
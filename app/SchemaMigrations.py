@@ -0,0 +1,54 @@
+import logging
+
+
+class SchemaMigrations:
+    """
+    Versioned changes of the database schema.
+
+    Every migration has a version, a name and a function receiving a cursor, and is applied once,
+    recording its version in the schema_migrations table. When the schema is up to date startup only
+    reads the current version. Replicas starting at the same time wait for each other on an advisory
+    lock instead of applying the same migration twice. Migrations are idempotent, so they can be
+    applied on databases created before the versions were tracked.
+    """
+
+    # Key of the advisory lock held while migrating
+    LOCK_KEY = 4618241
+
+    def __init__(self, database, migrations):
+        """
+        :param database: Database to migrate
+        :param migrations: (version, name, function) of every migration, in increasing version
+        """
+        self._database = database
+        self._migrations = sorted(migrations, key=lambda migration: migration[0])
+
+    def _current_version(self, cur):
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return 0
+        cur.execute("SELECT COALESCE(max(version), 0) FROM schema_migrations;")
+        return cur.fetchone()[0]
+
+    def migrate(self):
+        """
+        Apply the pending migrations, all of them in a single transaction
+
+        :return: Number of migrations applied
+        """
+        with self._database.cursor() as cur:
+            if self._current_version(cur) >= self._migrations[-1][0]:
+                return 0
+
+        with self._database.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (self.LOCK_KEY,))
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INT PRIMARY KEY, name VARCHAR NOT NULL, "
+                        "applied_at timestamp NOT NULL DEFAULT now())")
+            # Another replica might have migrated while waiting for the lock
+            current = self._current_version(cur)
+            pending = [migration for migration in self._migrations if migration[0] > current]
+            for version, name, function in pending:
+                logging.info(f'Applying migration {version}: {name}')
+                function(cur)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+        return len(pending)
@@ -0,0 +1,200 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from psycopg2.extras import execute_values
+
+
+class Session:
+    """
+    Conversation state of a chat
+    """
+    __slots__ = ('chat_id', 'phase', 'pending_name', 'story')
+
+    def __init__(self, chat_id, phase, pending_name=None, story=None):
+        self.chat_id = chat_id
+        self.phase = phase
+        self.pending_name = pending_name
+        # Id of the story the chat is playing, None for the default one
+        self.story = story
+
+
+class SessionStore:
+    """
+    Per-chat conversation state (registration phase, name pending confirmation and story being played).
+
+    Sessions are kept in memory for the hot path and written behind to the chat_session table by a
+    background thread, so they survive restarts without adding writes to the handlers.
+    """
+
+    # Conversation phases
+    IDLE = 'idle'
+    REQUESTING_NAME = 'requesting_name'
+    REQUESTING_LOCATION = 'requesting_location'
+
+    def __init__(self, database, flush_interval=1.0, max_sessions=10000):
+        self._database = database
+        self._flush_interval = flush_interval
+        self._max_sessions = max_sessions
+        self._lock = threading.Lock()
+        # chat_id -> Session, in least recently used order
+        self._sessions = OrderedDict()
+        # chat_ids modified since the last flush
+        self._dirty = set()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def create_table(cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS chat_session (chat_id BIGINT PRIMARY KEY, phase VARCHAR NOT NULL, pending_name VARCHAR, story VARCHAR)")
+        cur.execute("ALTER TABLE chat_session ADD COLUMN IF NOT EXISTS story VARCHAR")
+
+    def get(self, chat_id):
+        """
+        Get the session of a chat, loading it from the database if it is not in memory
+        """
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session:
+                self._sessions.move_to_end(chat_id)
+                return session
+
+        with self._database.cursor() as cur:
+            cur.execute("SELECT phase, pending_name, story FROM chat_session WHERE chat_id=%s;", (chat_id,))
+            row = cur.fetchone()
+
+        with self._lock:
+            # The session might have been created by another thread in the meantime
+            session = self._sessions.get(chat_id)
+            if not session:
+                session = Session(chat_id, *row) if row else Session(chat_id, self.IDLE)
+                self._sessions[chat_id] = session
+                self._evict()
+            return session
+
+    def update(self, chat_id, **fields):
+        """
+        Update the fields (phase, pending_name, story) of the session of a chat
+        """
+        session = self.get(chat_id)
+        with self._lock:
+            for name, value in fields.items():
+                setattr(session, name, value)
+            self._dirty.add(chat_id)
+        return session
+
+    def _evict(self):
+        """
+        Drop the least recently used sessions that are already persisted. Called with the lock held
+        """
+        excess = len(self._sessions) - self._max_sessions
+        for chat_id in list(self._sessions):
+            if excess <= 0:
+                break
+            if chat_id not in self._dirty:
+                del self._sessions[chat_id]
+                excess -= 1
+
+    def flush(self):
+        """
+        Write the modified sessions to the database
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            rows = [(chat_id, self._sessions[chat_id].phase, self._sessions[chat_id].pending_name, self._sessions[chat_id].story)
+                    for chat_id in self._dirty]
+            self._dirty.clear()
+
+        try:
+            with self._database.cursor() as cur:
+                execute_values(cur,
+                               "INSERT INTO chat_session (chat_id, phase, pending_name, story) VALUES %s "
+                               "ON CONFLICT (chat_id) DO UPDATE SET phase=EXCLUDED.phase, pending_name=EXCLUDED.pending_name, story=EXCLUDED.story",
+                               rows)
+        except Exception as e:
+            logging.error(f"Could not persist {len(rows)} sessions: {e}")
+            # Retry on the next flush unless they were modified again in the meantime
+            with self._lock:
+                self._dirty.update(row[0] for row in rows if row[0] in self._sessions)
+
+    def _run(self):
+        while not self._stop_event.wait(self._flush_interval):
+            self.flush()
+
+    def start(self):
+        """
+        Start the background thread writing the sessions behind
+        """
+        self._thread = threading.Thread(target=self._run, name='session-store', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and persist the pending changes
+        """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+
+class SharedSessionStore(SessionStore):
+    """
+    Per-chat conversation state read from and written to the chat_session table.
+
+    Nothing is kept in memory between updates, so every replica of the bot sees the same sessions. Within
+    a transaction the session is read once and kept in the transaction state, and its changes are written
+    once right before the commit, as part of the transaction of the handler.
+    """
+
+    def _transaction_sessions(self):
+        """
+        chat_id -> Session read in the current transaction, or None if there is no transaction
+        """
+        state = self._database.transaction_state()
+        return None if state is None else state.setdefault(SharedSessionStore, {})
+
+    def get(self, chat_id):
+        sessions = self._transaction_sessions()
+        if sessions is not None and chat_id in sessions:
+            return sessions[chat_id]
+
+        with self._database.cursor() as cur:
+            cur.execute("SELECT phase, pending_name, story FROM chat_session WHERE chat_id=%s;", (chat_id,))
+            row = cur.fetchone()
+        session = Session(chat_id, *row) if row else Session(chat_id, self.IDLE)
+        if sessions is not None:
+            sessions[chat_id] = session
+        return session
+
+    def update(self, chat_id, **fields):
+        session = self.get(chat_id)
+        for name, value in fields.items():
+            setattr(session, name, value)
+
+        state = self._database.transaction_state()
+        if state is None:
+            self._write(session)
+            return session
+        # Write the session once, with every change made in the transaction
+        dirty = state.setdefault((SharedSessionStore, 'dirty'), set())
+        if chat_id not in dirty:
+            dirty.add(chat_id)
+            self._database.before_commit(lambda: self._write(session))
+        return session
+
+    def _write(self, session):
+        with self._database.cursor() as cur:
+            cur.execute("INSERT INTO chat_session (chat_id, phase, pending_name, story) VALUES (%s,%s,%s,%s) "
+                        "ON CONFLICT (chat_id) DO UPDATE SET phase=EXCLUDED.phase, pending_name=EXCLUDED.pending_name, story=EXCLUDED.story;",
+                        (session.chat_id, session.phase, session.pending_name, session.story))
+
+    def flush(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
@@ -0,0 +1,123 @@
+import logging
+import threading
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+
+class StepEventLog:
+    """
+    Append-only log of the progress of the chats, in the chat_event table.
+
+    chat_data only keeps the current state of every chat, so every transition (registering, moving to a
+    step, answering a question, failing an answer, using a help) is also recorded here as an event, which
+    gives the time spent in every step and the funnel of the story. Events are buffered once the
+    transaction of the handler is committed and written in batches by a background thread, so recording
+    them adds no writes to the player path. The chat_step_times and chat_event_progress views derive the
+    split times and the current state of the chats from the events.
+    """
+
+    REGISTER = 'register'
+    STEP = 'step'
+    ANSWER = 'answer'
+    WRONG_ANSWER = 'wrong_answer'
+    HELP = 'help'
+
+    def __init__(self, database, flush_interval=2.0, batch_size=500, max_pending=100000):
+        """
+        :param database: Database the events are written to
+        :param flush_interval: Maximum seconds an event waits to be written
+        :param batch_size: Events written in a single statement, and pending events that trigger a write right away
+        :param max_pending: Maximum events kept while the database is unavailable, the oldest are dropped
+        """
+        self._database = database
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        # (chat_id, story, event, step, question, time) rows not written yet, in the order they happened
+        self._pending = []
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    @staticmethod
+    def create_table(cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS chat_event (id BIGSERIAL PRIMARY KEY, chat_id BIGINT NOT NULL, story VARCHAR NOT NULL, "
+                    "event VARCHAR NOT NULL, step INT, question INT, time TIMESTAMP NOT NULL)")
+        cur.execute("CREATE INDEX IF NOT EXISTS chat_event_story_chat_idx ON chat_event (story, chat_id, id)")
+        # Time from the arrival to every step until the arrival to the next one (NULL for the current step)
+        cur.execute("CREATE OR REPLACE VIEW chat_step_times AS "
+                    "SELECT story, chat_id, step, time AS started, lead(time) OVER chat AS finished, lead(time) OVER chat - time AS duration "
+                    "FROM chat_event WHERE event='step' WINDOW chat AS (PARTITION BY story, chat_id ORDER BY id)")
+        # Current step and question of every chat, as stored in chat_data
+        cur.execute("CREATE OR REPLACE VIEW chat_event_progress AS "
+                    "SELECT DISTINCT ON (story, chat_id) story, chat_id, step AS current_step, question AS current_question, time AS updated "
+                    "FROM chat_event WHERE event IN ('register', 'step', 'answer') ORDER BY story, chat_id, id DESC")
+
+    def record(self, chat_id, story, event, step=None, question=None):
+        """
+        Record an event of a chat once the current transaction is committed
+
+        :param event: Kind of event, one of the constants of the class
+        :param step: Step of the chat after the event
+        :param question: Question of the chat after the event
+        """
+        row = (chat_id, story, event, step, question, datetime.now())
+        self._database.after_commit(lambda: self._append([row]))
+
+    def _append(self, rows, front=False):
+        with self._lock:
+            if front:
+                self._pending[:0] = rows
+            else:
+                self._pending.extend(rows)
+            excess = len(self._pending) - self._max_pending
+            if excess > 0:
+                del self._pending[:excess]
+                logging.error(f'Dropped {excess} step events that could not be written')
+            # Events put back after a failed write wait for the next flush instead of retrying right away
+            full = not front and len(self._pending) >= self._batch_size
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Write the pending events to the database
+        """
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return
+
+        try:
+            with self._database.cursor() as cur:
+                execute_values(cur, "INSERT INTO chat_event (chat_id, story, event, step, question, time) VALUES %s",
+                               rows, page_size=self._batch_size)
+        except Exception as e:
+            logging.error(f'Could not write {len(rows)} step events: {e}')
+            # Retry on the next flush, before the events that happened in the meantime
+            self._append(rows, front=True)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        """
+        Start the background thread writing the events
+        """
+        self._thread = threading.Thread(target=self._run, name='step-event-log', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and write the pending events
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,72 @@
+import json
+import os
+import re
+
+from StoryIndex import StoryIndex
+
+# Story ids are used as /start deep link payloads, which only allow these characters
+STORY_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class Story:
+    """
+    An adventure served by the bot: its history config and the directory of its media
+    """
+    __slots__ = ('id', 'title', 'index', 'media_dir')
+
+    def __init__(self, story_id, title, index, media_dir):
+        self.id = story_id
+        self.title = title
+        self.index = index
+        self.media_dir = media_dir
+
+    def media_path(self, kind, name):
+        """
+        Path of a media file of the story
+
+        :param kind: Type of media, i.e. the subdirectory ('image' or 'audio')
+        :param name: Name of the file as written in the history config
+        """
+        return os.path.join(self.media_dir, kind, name)
+
+
+class StoryCatalog:
+    """
+    Stories served by the bot, listed in a catalog file.
+
+    Every entry of the catalog has the id of the story (used in the /start deep links), its title, the
+    path of its history config and the directory of its media. Each history config gets its own
+    StoryIndex, so stories can still be edited live. The first story is the default one, played by
+    the chats that did not choose another one.
+    """
+
+    def __init__(self, path, base_dir=''):
+        """
+        :param path: Path of the catalog file
+        :param base_dir: Directory the relative paths of the history configs and media directories are relative to
+        """
+        with open(path) as catalog_file:
+            entries = json.load(catalog_file)
+
+        self._stories = {}
+        for entry in entries:
+            story_id = entry['id']
+            if not STORY_ID.match(story_id):
+                raise ValueError(f'Invalid story id {story_id!r} in {path}')
+            if story_id in self._stories:
+                raise ValueError(f'Duplicated story id {story_id!r} in {path}')
+            self._stories[story_id] = Story(story_id, entry.get('title', story_id), StoryIndex(os.path.join(base_dir, entry['config'])),
+                                            os.path.join(base_dir, entry.get('media', 'media')))
+
+        if not self._stories:
+            raise ValueError(f'The story catalog {path} does not contain any story')
+        self.default = next(iter(self._stories.values()))
+
+    def get(self, story_id):
+        """
+        Get the story with the given id, or None if it does not exist
+        """
+        return self._stories.get(story_id)
+
+    def __iter__(self):
+        return iter(self._stories.values())
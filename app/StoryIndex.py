@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from AnswerMatcher import AnswerMatcher
+
+
+class StoryIndex:
+    """
+    In-memory index of a history config file.
+
+    The file is parsed once into a dict keyed by step id, with the questions of every step keyed by
+    question id, the answer matcher of every question and the last step precomputed. Every lookup performs a cheap stat() of the file and
+    the index is only rebuilt when the modification time or size change and the content hash differs,
+    so the story can still be edited live without restarting the bot. If an edit leaves the file
+    unreadable or invalid, the last good version keeps being served. The first load has no version to
+    fall back to, so it fails if the file is missing or invalid.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # (mtime_ns, size) of the last file version that was inspected, valid or not
+        self._signature = None
+        # Hash of the content currently indexed
+        self._digest = None
+        self._steps = {}
+        self._questions = {}
+        self._matchers = {}
+        self._last_step = None
+        self._refresh(initial=True)
+
+    def _refresh(self, initial=False):
+        """
+        Rebuild the index if the file changed since the last inspection
+
+        :param initial: Raise the errors instead of keeping the last loaded version, as there is none yet
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if initial:
+                raise
+            if self._signature is not None:
+                logging.error(f"File not found: {self.path}. Keeping the last loaded version")
+                self._signature = None
+            return
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+
+        with self._lock:
+            # Another thread might have reloaded the file while waiting for the lock
+            if signature == self._signature:
+                return
+
+            try:
+                with open(self.path, 'rb') as history_file:
+                    content = history_file.read()
+            except OSError as e:
+                if initial:
+                    raise
+                logging.error(f"Could not read {self.path}: {e}")
+                return
+
+            digest = hashlib.sha256(content).hexdigest()
+            if digest != self._digest:
+                try:
+                    self._build(json.loads(content))
+                except Exception as e:
+                    if initial:
+                        raise ValueError(f"Invalid history config in {self.path}: {e}") from e
+                    logging.error(f"Invalid history config in {self.path}, keeping the last loaded version: {e}")
+                    # Remember this version so it is not parsed again until the file changes
+                    self._signature = signature
+                    return
+                self._digest = digest
+                logging.info(f"Loaded history config {self.path} ({len(self._steps)} steps)")
+
+            self._signature = signature
+
+    def _build(self, history_data):
+        """
+        Build the lookup tables from the parsed history data and swap them in
+        """
+        steps = {}
+        questions = {}
+        matchers = {}
+        for step_data in history_data:
+            step_id = step_data['id']
+            steps[step_id] = step_data
+            questions[step_id] = {question['id']: question for question in step_data.get('questions', [])}
+            matchers[step_id] = {question_id: AnswerMatcher.from_question(question) for question_id, question in questions[step_id].items()}
+
+        if not steps:
+            raise ValueError('The history config does not contain any step')
+
+        # Assign the new tables at the end so readers never see a partially built index
+        self._steps, self._questions, self._matchers, self._last_step = steps, questions, matchers, max(steps)
+
+    def get_step(self, step_id):
+        """
+        Get the data of the step with the given id, or None if it does not exist
+        """
+        self._refresh()
+        return self._steps.get(step_id)
+
+    def get_question(self, step_id, question_id):
+        """
+        Get the question with the given id inside a step, or None if it does not exist
+        """
+        self._refresh()
+        return self._questions.get(step_id, {}).get(question_id)
+
+    def get_matcher(self, step_id, question_id):
+        """
+        Get the AnswerMatcher of a question, or None if the question does not exist or has no answer
+        """
+        self._refresh()
+        return self._matchers.get(step_id, {}).get(question_id)
+
+    def get_last_step(self):
+        """
+        Get the maximum step id in the history config file
+        """
+        self._refresh()
+        return self._last_step
@@ -0,0 +1,124 @@
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Attributes of every LogRecord, the rest are the extra fields of the call
+STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats the records as one JSON object per line, with the extra fields of the call as keys
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_ATTRIBUTES and name != 'sample':
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Limits the records of high-frequency events, logged with extra={'sample': '<event>'}, to a number per
+    second for every event. The first record let through after others were dropped carries their count
+    in its 'sampled_out' field. Records without a sample key are never dropped.
+    """
+
+    def __init__(self, rate=1):
+        """
+        :param rate: Records per second let through for every sampled event
+        """
+        super().__init__()
+        self._rate = rate
+        self._lock = threading.Lock()
+        # event -> [start of the current second, records let through in it, records dropped since the last one]
+        self._events = {}
+
+    def filter(self, record):
+        event = getattr(record, 'sample', None)
+        if event is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            window = self._events.get(event)
+            if window is None:
+                window = self._events[event] = [now, 0, 0]
+            elif now - window[0] >= 1:
+                window[0], window[1] = now, 0
+            if window[1] >= self._rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            dropped, window[2] = window[2], 0
+        if dropped:
+            record.sampled_out = dropped
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of the records to the listener thread
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level='INFO', logger_levels=None, json_format=True, sample_rate=1):
+    """
+    Send the logs through a queue to a background thread writing them to stderr, so the threads
+    logging only pay for queuing the record
+
+    :param level: Level of the root logger
+    :param logger_levels: dict of logger name -> level, e.g. to silence the libraries
+    :param json_format: Write JSON records instead of plain text lines
+    :param sample_rate: Records per second logged for every sampled high-frequency event
+    :return: QueueListener writing the logs, to be stopped on shutdown
+    """
+    output = logging.StreamHandler()
+    if json_format:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in (logger_levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def parse_levels(text):
+    """
+    Parse per-logger levels written as 'name=LEVEL,name=LEVEL'
+    """
+    levels = {}
+    for item in text.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
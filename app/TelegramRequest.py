@@ -0,0 +1,54 @@
+import time
+
+from telegram import InputFile
+from telegram.utils.request import Request
+
+# Methods sending or editing messages in a chat, subject to the rate limits of Telegram
+PACED_METHODS = ('send', 'edit', 'forward', 'copy')
+
+
+class InstrumentedRequest(Request):
+    """
+    Request to the Bot API reporting the duration of every call and the size of the uploaded files.
+    Messages sent to chats go through the scheduler, if any, to respect the rate limits. Waiting for
+    the scheduler inside a handler would keep its database connection and row locks for as long, so
+    the messages sent inside a transaction can be deferred until it is committed. The caller then gets
+    True instead of the sent message, so sends whose result is needed have to run after the commit.
+    """
+
+    def __init__(self, on_request, *args, scheduler=None, defer=None, **kwargs):
+        """
+        :param on_request: Callable receiving the method, the seconds it took, the uploaded bytes and whether it failed
+        :param scheduler: OutboundScheduler pacing the messages sent to chats
+        :param defer: Callable receiving a paced call, which returns True if it will run it later (e.g. after the
+                      commit of the current transaction) and False if the call has to be made right away
+        """
+        super().__init__(*args, **kwargs)
+        self._on_request = on_request
+        self._scheduler = scheduler
+        self._defer = defer
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        chat_id = (data or {}).get('chat_id')
+        if self._scheduler and chat_id is not None and method.startswith(PACED_METHODS):
+            def send():
+                # Post a copy every time, since the values are replaced by the encoded fields when posting
+                return self._scheduler.send(chat_id, lambda: self._post(method, url, dict(data), timeout))
+
+            if self._defer and self._defer(send):
+                return True
+            return send()
+        return self._post(method, url, data, timeout)
+
+    def _post(self, method, url, data, timeout):
+        # The values are replaced by the encoded fields when posting, so measure the files before
+        upload_size = sum(len(value.input_file_content) for value in (data or {}).values() if isinstance(value, InputFile))
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().post(url, data, timeout)
+            failed = False
+            return result
+        finally:
+            self._on_request(method, time.perf_counter() - started, upload_size, failed)
@@ -0,0 +1,85 @@
+import gzip
+import json
+import logging
+import queue
+import threading
+import time
+import zlib
+
+
+def read_recording(path):
+    """
+    Iterate over the (arrival timestamp, update dict) entries of a recording, in the order they were received.
+    A truncated last line, e.g. if the bot was killed while writing it, is ignored.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as recording:
+        try:
+            for line in recording:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                yield entry['t'], entry['update']
+        except EOFError:
+            pass
+
+
+class UpdateRecorder:
+    """
+    Appends every incoming update to a recording, to reproduce the traffic later with benchmark/replay.py.
+
+    The recording is a gzip file with one JSON object per line holding the arrival timestamp ('t') and the
+    update as received from Telegram ('update'). Updates are queued by the dispatcher and written by a
+    background thread, which flushes the compressed stream every few seconds so the recording can be read
+    while the bot is running and at most those seconds are lost if it is killed. Restarting the bot appends
+    a new gzip member to the same file.
+    """
+
+    def __init__(self, path, flush_interval=5.0):
+        """
+        :param path: File the updates are appended to
+        :param flush_interval: Maximum seconds an update stays in the compression buffer
+        """
+        self._path = path
+        self._flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def record(self, update, context=None):
+        """
+        Dispatcher handler queuing the update to be written. It never stops the update from being handled
+        """
+        self._queue.put((time.time(), update.to_dict()))
+
+    def _run(self):
+        with gzip.open(self._path, 'ab') as recording:
+            pending = False
+            while True:
+                try:
+                    entry = self._queue.get(timeout=self._flush_interval if pending else None)
+                except queue.Empty:
+                    recording.flush(zlib.Z_SYNC_FLUSH)
+                    pending = False
+                    continue
+                if entry is None:
+                    return
+                arrival, update = entry
+                try:
+                    recording.write(json.dumps({'t': round(arrival, 3), 'update': update},
+                                               ensure_ascii=False, separators=(',', ':')).encode() + b'\n')
+                    pending = True
+                except Exception as e:
+                    logging.error(f'Could not record update {update.get("update_id")}: {e}')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='update-recorder', daemon=True)
+        self._thread.start()
+        logging.info(f'Recording the incoming updates to {self._path}')
+
+    def stop(self):
+        """
+        Write the queued updates and close the recording
+        """
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,160 @@
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+
+class WebhookServer:
+    """
+    Embedded HTTP server receiving the updates pushed by Telegram.
+
+    Updates POSTed to the webhook path are checked against the secret token sent by Telegram in the
+    X-Telegram-Bot-Api-Secret-Token header, deserialized and put straight into the dispatcher queue.
+    The same server answers the health (/healthz) and readiness (/readyz) probes. Nothing here talks
+    to Telegram, so recorded updates can be POSTed to it locally. When several replicas of the bot run,
+    updates of chats owned by another replica are forwarded to it through the router. Replays can ask
+    the server to answer only once every update has been handled (wait_handled), which the bot reports
+    by calling handled().
+    """
+
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+    # Maximum accepted size of an update in bytes
+    MAX_BODY_SIZE = 1 << 20
+
+    def __init__(self, bot, update_queue, listen='0.0.0.0', port=8443, path='/webhook', secret_token=None, is_ready=None, router=None,
+                 wait_handled=0):
+        """
+        :param bot: Bot the updates are bound to
+        :param update_queue: Queue of the dispatcher
+        :param listen: Address to listen on
+        :param port: Port to listen on
+        :param path: Path the updates are POSTed to
+        :param secret_token: Secret token expected in the updates, or None to accept any
+        :param is_ready: Callable telling whether the bot is ready to process updates
+        :param router: ReplicaRouter forwarding the updates to the replica owning their chat, or None to process all of them
+        :param wait_handled: Seconds to wait for an update to be handled before answering its request,
+                             0 to answer as soon as it is queued
+        """
+        self._bot = bot
+        self._update_queue = update_queue
+        self._path = path
+        self._secret_token = secret_token
+        self._is_ready = is_ready or (lambda: True)
+        self._router = router
+        self._wait_handled = wait_handled
+        self._handled_lock = threading.Lock()
+        # update_id -> Event set once the update is handled, for the requests waiting for it
+        self._handled = {}
+        self._server = ThreadingHTTPServer((listen, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _build_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/healthz':
+                    self._reply(200, 'ok')
+                elif self.path == '/readyz':
+                    ready = server._check_ready()
+                    self._reply(200 if ready else 503, 'ready' if ready else 'not ready')
+                else:
+                    self._reply(404, 'not found')
+
+            def do_POST(self):
+                if self.path != server._path:
+                    self._reply(404, 'not found')
+                    return
+                if not server._check_secret(self.headers.get(server.SECRET_HEADER)):
+                    logging.warning(f'Rejected webhook request from {self.client_address[0]} with a wrong secret token')
+                    self._reply(403, 'forbidden')
+                    return
+
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > server.MAX_BODY_SIZE:
+                    self._reply(400, 'invalid length')
+                    return
+
+                body = self.rfile.read(length)
+                try:
+                    update = Update.de_json(json.loads(body), server._bot)
+                except Exception as e:
+                    logging.error(f'Invalid update received in the webhook: {e}')
+                    self._reply(400, 'invalid update')
+                    return
+
+                if (server._router and update.effective_chat and not self.headers.get(server._router.FORWARDED_HEADER)
+                        and server._router.forward(update.effective_chat.id, body)):
+                    self._reply(200, 'ok')
+                    return
+
+                if not server._wait_handled:
+                    server._update_queue.put(update)
+                    self._reply(200, 'ok')
+                    return
+
+                handled = threading.Event()
+                with server._handled_lock:
+                    server._handled[update.update_id] = handled
+                server._update_queue.put(update)
+                if not handled.wait(server._wait_handled):
+                    logging.warning('Update %s not handled in %s seconds', update.update_id, server._wait_handled)
+                with server._handled_lock:
+                    server._handled.pop(update.update_id, None)
+                self._reply(200, 'ok')
+
+            def _reply(self, status, text):
+                body = text.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('Webhook %s ' + format, self.address_string(), *args)
+
+        return Handler
+
+    def handled(self, update_id):
+        """
+        Report that an update has been handled, answering its request if it is waiting for it
+        """
+        with self._handled_lock:
+            handled = self._handled.get(update_id)
+        if handled:
+            handled.set()
+
+    def _check_secret(self, received):
+        if not self._secret_token:
+            return True
+        return received is not None and hmac.compare_digest(received.encode(), self._secret_token.encode())
+
+    def _check_ready(self):
+        try:
+            return bool(self._is_ready())
+        except Exception as e:
+            logging.error(f'Readiness check failed: {e}')
+            return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook-server', daemon=True)
+        self._thread.start()
+        logging.info(f'Webhook server listening on port {self.port}')
+
+    def stop(self):
+        """
+        Stop accepting requests and close the server
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qsl
+
+
+class SentMessage:
+    """
+    Call of the bot to a method of the Bot API addressed to a chat
+    """
+    __slots__ = ('time', 'method', 'text')
+
+    def __init__(self, time, method, text):
+        self.time = time
+        self.method = method
+        self.text = text
+
+
+class FakeBotApi:
+    """
+    Local stand-in for the Telegram Bot API.
+
+    It answers every method with a plausible result, so the bot runs unchanged against it, and records
+    the calls addressed to every chat, so the load test can wait for the replies of the bot.
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Geocache', 'username': 'geocache_bench_bot'}
+
+    def __init__(self, listen='127.0.0.1', port=0):
+        self._lock = threading.Condition()
+        # chat_id -> list of SentMessage, in the order they were received
+        self._sent = {}
+        self._message_ids = count(1)
+        self._server = ThreadingHTTPServer((listen, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """
+        Base URL to give to the bot, which appends the token and the method
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def cursor(self, chat_id):
+        """
+        Position of the next call to the chat, to wait for the calls made after it
+        """
+        with self._lock:
+            return len(self._sent.get(chat_id, ()))
+
+    def wait_for(self, chat_id, cursor, predicate, timeout):
+        """
+        Wait for a call to the chat after the cursor matching the predicate
+
+        :return: The matching SentMessage, or None if it did not arrive within the timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                sent = self._sent.get(chat_id, [])
+                for index in range(cursor, len(sent)):
+                    if predicate(sent[index]):
+                        return sent[index]
+                cursor = len(sent)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def sent(self, chat_id):
+        """
+        Calls addressed to the chat so far, in the order they were received
+        """
+        with self._lock:
+            return list(self._sent.get(chat_id, ()))
+
+    def _record(self, method, params):
+        chat_id = params.get('chat_id')
+        if chat_id is None:
+            return
+        with self._lock:
+            self._sent.setdefault(int(chat_id), []).append(SentMessage(time.monotonic(), method, params.get('text') or ''))
+            self._lock.notify_all()
+
+    def _result(self, method, params):
+        """
+        Result returned to the bot for a call
+        """
+        if method == 'getMe':
+            return self.BOT_USER
+        if not method.startswith('send') and method != 'editMessageReplyMarkup':
+            return True
+
+        message = {
+            'message_id': params.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'from': self.BOT_USER
+        }
+        if method == 'sendMessage':
+            message['text'] = params.get('text', '')
+        elif method == 'sendPhoto':
+            file_id = f'photo-{message["message_id"]}'
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960}]
+        elif method == 'sendAudio':
+            file_id = f'audio-{message["message_id"]}'
+            message['audio'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 60}
+        return message
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            form = BytesParser(policy=default_policy).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            return {part.get_param('name', header='content-disposition'): '' if part.get_filename() else part.get_content()
+                    for part in form.iter_parts()}
+        return dict(parse_qsl(body.decode()))
+
+    def _build_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                params = api._parse_params(self.headers.get('Content-Type', ''), body)
+                api._record(method, params)
+
+                response = json.dumps({'ok': True, 'result': api._result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,394 @@
+"""
+Load test of the bot with simulated player groups.
+
+The bot runs unchanged in a subprocess in webhook mode, talking to a local stand-in of the Telegram
+Bot API and to a throwaway PostgreSQL container. Every group is driven through the whole story of
+config/history_metadata.json (registration, live location, radar, help, answers and finish), and the
+latency of every action is measured from the moment the update is posted until the expected reply
+of the bot arrives.
+
+Usage: python benchmark/load_test.py --groups 50
+"""
+import argparse
+import json
+import math
+import os
+import random
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from itertools import count
+
+from fake_bot_api import FakeBotApi
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+# Offset in degrees from the target of the positions far from it (about 550 meters)
+FAR_OFFSET = 0.005
+# Live period of the shared location in seconds
+LIVE_PERIOD = 8 * 3600
+
+
+class ThrowawayPostgres:
+    """
+    PostgreSQL container removed when the test finishes
+    """
+
+    def __init__(self, image='postgres:13.4'):
+        self.image = image
+        self.container_id = None
+        self.env = {'POSTGRES_USER': 'bench', 'POSTGRES_PASSWORD': secrets.token_hex(8), 'POSTGRES_DB': 'bench'}
+
+    def start(self, timeout=60):
+        command = ['docker', 'run', '-d', '--rm', '-p', '127.0.0.1::5432']
+        for name, value in self.env.items():
+            command += ['-e', f'{name}={value}']
+        self.container_id = subprocess.check_output(command + [self.image], text=True).strip()
+
+        port = subprocess.check_output(['docker', 'port', self.container_id, '5432/tcp'], text=True).splitlines()[0].rsplit(':', 1)[1]
+        self.env.update(POSTGRES_HOST='127.0.0.1', POSTGRES_PORT=port)
+
+        # The server only listens on TCP once the initialization of the database is done
+        deadline = time.monotonic() + timeout
+        while subprocess.call(['docker', 'exec', self.container_id, 'pg_isready', '-h', '127.0.0.1', '-U', 'bench'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+            if time.monotonic() > deadline:
+                raise RuntimeError('PostgreSQL did not start in time')
+            time.sleep(0.5)
+
+    def stop(self):
+        if self.container_id:
+            subprocess.call(['docker', 'rm', '-f', self.container_id], stdout=subprocess.DEVNULL)
+
+
+class BotProcess:
+    """
+    The bot running in webhook mode in a subprocess
+    """
+
+    def __init__(self, env, log_path, app_dir=APP_DIR):
+        self.port = _free_port()
+        self.secret = secrets.token_hex(16)
+        self.url = f'http://127.0.0.1:{self.port}'
+        self._env = dict(os.environ, **env,
+                         TELEGRAM_BOT_TOKEN='123456:bench',
+                         BOT_MODE='webhook',
+                         WEBHOOK_URL='',
+                         WEBHOOK_LISTEN='127.0.0.1',
+                         WEBHOOK_PORT=str(self.port),
+                         WEBHOOK_SECRET=self.secret,
+                         GEOFENCE_CONFIRMATIONS='2',
+                         METRICS_PORT='0')
+        self._log_path = log_path
+        self._app_dir = app_dir
+        self._process = None
+
+    def start(self, timeout=60):
+        """
+        Start the bot and wait until it reports it is ready
+
+        :return: Seconds from the start of the process until it was ready
+        """
+        log = open(self._log_path, 'ab')
+        started = time.monotonic()
+        self._process = subprocess.Popen([sys.executable, 'GeocacheAlcalaBot.py'], cwd=self._app_dir, env=self._env, stdout=log, stderr=log)
+        log.close()
+
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._process.poll() is not None:
+                raise RuntimeError(f'The bot exited with code {self._process.returncode}, see {self._log_path}')
+            try:
+                with urllib.request.urlopen(self.url + '/readyz', timeout=1) as response:
+                    if response.status == 200:
+                        return time.monotonic() - started
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError('The bot did not become ready in time')
+            time.sleep(0.2)
+
+    def post(self, update):
+        request = urllib.request.Request(self.url + '/webhook', data=json.dumps(update).encode(), headers={
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': self.secret
+        })
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+
+    def stop(self, timeout=30):
+        if not self._process or self._process.poll() is not None:
+            return
+        self._process.send_signal(signal.SIGTERM)
+        try:
+            self._process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+
+class Results:
+    """
+    Latencies in seconds and failures of every action
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+        self.updates = 0
+        self.finished_groups = 0
+
+    def add(self, action, latency):
+        with self._lock:
+            self.latencies.setdefault(action, []).append(latency)
+
+    def fail(self, action):
+        with self._lock:
+            self.failures[action] = self.failures.get(action, 0) + 1
+
+    def count_update(self):
+        with self._lock:
+            self.updates += 1
+
+    def finish_group(self):
+        with self._lock:
+            self.finished_groups += 1
+
+
+class ActionFailed(Exception):
+    pass
+
+
+class Group:
+    """
+    Simulated player group going through the whole story
+    """
+
+    _update_ids = count(1)
+
+    def __init__(self, index, run_id, story, bot, api, results, options):
+        self.chat_id = 10**12 + index
+        self.name = f'bench-{run_id}-{index}'
+        self.story = story
+        self.last_step = max(story)
+        self._bot = bot
+        self._api = api
+        self._results = results
+        self._options = options
+        self._message_ids = count(1)
+        self._location_message_id = None
+        self._location_date = None
+
+    # Updates
+
+    def _chat(self):
+        return {'id': self.chat_id, 'type': 'private', 'first_name': self.name}
+
+    def _user(self):
+        return {'id': self.chat_id, 'is_bot': False, 'first_name': self.name}
+
+    def _message(self, **fields):
+        return dict(message_id=next(self._message_ids), date=int(time.time()), chat=self._chat(), **{'from': self._user()}, **fields)
+
+    def _text(self, text):
+        message = self._message(text=text)
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'message': message}
+
+    def _callback(self, data):
+        return {'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user(),
+            'chat_instance': str(self.chat_id),
+            'data': str(data),
+            'message': dict(message_id=next(self._message_ids), date=int(time.time()), chat=self._chat(), **{'from': FakeBotApi.BOT_USER})
+        }}
+
+    def _live_location(self, latitude, longitude):
+        message = self._message(location={'latitude': latitude, 'longitude': longitude, 'live_period': LIVE_PERIOD})
+        self._location_message_id, self._location_date = message['message_id'], message['date']
+        return {'message': message}
+
+    def _location_edit(self, latitude, longitude):
+        return {'edited_message': dict(
+            message_id=self._location_message_id,
+            date=self._location_date,
+            edit_date=int(time.time()),
+            chat=self._chat(),
+            location={'latitude': latitude, 'longitude': longitude, 'live_period': LIVE_PERIOD, 'horizontal_accuracy': 5},
+            **{'from': self._user()}
+        )}
+
+    # Actions
+
+    def _send(self, action, update, expected=None):
+        """
+        Post an update and wait for the reply of the bot containing the expected text (or only for the
+        webhook to accept it if there is nothing expected)
+        """
+        if self._options.think_time:
+            time.sleep(random.uniform(0, 2 * self._options.think_time))
+
+        update['update_id'] = next(self._update_ids)
+        cursor = self._api.cursor(self.chat_id)
+        started = time.monotonic()
+        try:
+            self._bot.post(update)
+        except (urllib.error.URLError, ConnectionError) as e:
+            self._results.fail(action)
+            raise ActionFailed(f'{action}: {e}')
+        self._results.count_update()
+
+        if expected is None:
+            self._results.add(action, time.monotonic() - started)
+            return
+
+        reply = self._api.wait_for(self.chat_id, cursor, lambda sent: expected in sent.text, self._options.timeout)
+        if not reply:
+            self._results.fail(action)
+            raise ActionFailed(f'{action}: no reply containing {expected!r} in {self._options.timeout} seconds')
+        self._results.add(action, reply.time - started)
+
+    def _wait_processed(self):
+        """
+        Wait until the bot processed the updates already posted to the chat, by posting a message it
+        always replies to. Updates of a chat are processed in order, so any reply means the previous ones
+        are done. Needed between live location edits, since an edit still queued is replaced by the next one
+        """
+        self._send('sync', self._text('¿Seguimos?'), '')
+
+    def _step_title(self, step_id):
+        return f'<b>{self.story[step_id]["title"]}</b>'
+
+    def run(self):
+        options = self._options
+        first_target = self.story[1]['next_coordinates']
+
+        # Registration
+        self._send('start', self._text('/start'), 'Hola, soy GeocacheBot')
+        self._send('name', self._text(self.name), 'Tu nombre es')
+        self._send('confirm_name', self._callback(1), 'ubicación en tiempo real')
+        self._send('share_location', self._live_location(first_target[0] + FAR_OFFSET, first_target[1]), self._step_title(0))
+        self._send('next_step', self._callback(1), 'botón de ayuda a la navegación')
+
+        step_id = 1
+        while step_id < self.last_step - 1:
+            latitude, longitude = self.story[step_id]['next_coordinates']
+
+            # Navigation: radar far from the target, maybe a help, and arrival detected from the live location
+            self._send('location_edit', self._location_edit(latitude + FAR_OFFSET, longitude))
+            self._send('radar', self._text('Radar portatemporal 🧭'), 'El objetivo se encuentra')
+            if random.random() < options.help_rate:
+                self._send('help', self._callback(-1), 'aquí tienes las coordenadas')
+            self._send('location_edit', self._location_edit(latitude, longitude))
+            self._wait_processed()
+            step_id += 1
+            arrival = self._step_title(step_id) if step_id == self.last_step - 1 else 'Estáis demasiado cerca'
+            self._send('arrival', self._location_edit(latitude, longitude), arrival)
+
+            if step_id != self.last_step - 1:
+                self._send('next_step', self._callback(step_id), self._step_title(step_id))
+
+            questions = self.story[step_id].get('questions', [])
+            if not questions:
+                raise ActionFailed(f'Step {step_id} has no questions to continue the navigation')
+            if step_id != self.last_step - 1:
+                self._send('to_questions', self._callback(-2), questions[0]['question_text'][:40])
+
+            for index, question in enumerate(questions):
+                if random.random() < options.wrong_answer_rate:
+                    self._send('wrong_answer', self._text('no lo sé'), 'Inténtalo de nuevo')
+                if index + 1 < len(questions):
+                    expected = questions[index + 1]['question_text'][:40]
+                elif step_id == self.last_step - 1:
+                    expected = self._step_title(self.last_step)
+                else:
+                    expected = 'botón de ayuda a la navegación'
+                self._send('finish' if expected == self._step_title(self.last_step) else 'answer', self._text(question['answer']), expected)
+
+        self._results.finish_group()
+
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values, percent):
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def report(results, groups, elapsed):
+    print(f'\n{results.finished_groups}/{groups} groups finished in {elapsed:.1f} s, '
+          f'{results.updates} updates ({results.updates / elapsed:.1f} updates/s)\n')
+    print(f'{"action":<16}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}{"failed":>8}')
+    for action in sorted(set(results.latencies) | set(results.failures)):
+        latencies = sorted(results.latencies.get(action, []))
+        if latencies:
+            stats = [_percentile(latencies, p) * 1000 for p in (50, 95, 99)] + [latencies[-1] * 1000]
+            print(f'{action:<16}{len(latencies):>8}' + ''.join(f'{value:>10.1f}' for value in stats) + f'{results.failures.get(action, 0):>8}')
+        else:
+            print(f'{action:<16}{0:>8}' + f'{"-":>10}' * 4 + f'{results.failures.get(action, 0):>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the bot with simulated player groups')
+    parser.add_argument('--groups', type=int, default=20, help='Number of simultaneous groups')
+    parser.add_argument('--ramp-up', type=float, default=5.0, help='Seconds to start all the groups')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Mean seconds between the actions of a group')
+    parser.add_argument('--help-rate', type=float, default=0.2, help='Probability of asking for help in each navigation')
+    parser.add_argument('--wrong-answer-rate', type=float, default=0.2, help='Probability of a wrong answer before each right one')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for each reply of the bot')
+    parser.add_argument('--external-db', action='store_true', help='Use the POSTGRES_* environment variables instead of a throwaway container')
+    parser.add_argument('--bot-log', default=os.devnull, help='File to write the output of the bot to')
+    options = parser.parse_args()
+
+    with open(os.path.join(APP_DIR, 'config', 'history_metadata.json')) as history_file:
+        story = {step['id']: step for step in json.load(history_file)}
+
+    api = FakeBotApi()
+    api.start()
+    database = None if options.external_db else ThrowawayPostgres()
+    bot = None
+    try:
+        if database:
+            database.start()
+        bot = BotProcess(dict(database.env if database else {}, TELEGRAM_API_URL=api.base_url), options.bot_log)
+        print(f'Bot ready in {bot.start():.2f} s')
+
+        results = Results()
+        run_id = secrets.token_hex(3)
+
+        def run_group(index):
+            try:
+                Group(index, run_id, story, bot, api, results, options).run()
+            except ActionFailed as e:
+                print(f'Group {index} aborted: {e}', file=sys.stderr)
+
+        threads = [threading.Thread(target=run_group, args=(index,), daemon=True) for index in range(options.groups)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+            time.sleep(options.ramp_up / max(options.groups, 1))
+        for thread in threads:
+            thread.join()
+
+        report(results, options.groups, time.monotonic() - started)
+    finally:
+        if bot:
+            bot.stop()
+        if database:
+            database.stop()
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Replay of the updates recorded in production (UPDATE_RECORDING) against the bot.
+
+The bot runs unchanged in a subprocess in webhook mode, talking to a local stand-in of the Telegram
+Bot API and to a throwaway PostgreSQL container, as in the load test. The recorded updates of every
+chat are posted in the order they arrived, either keeping their original pace (scaled by --speed) or as
+fast as possible (--speed 0). The dates of the messages are moved to the moment they are replayed, so
+the bot does not discard them as stale. The latency of an update is measured until the first call of
+the bot to its chat, and it is reported by kind of update together with the throughput.
+
+To get the same outcome on every run, whatever the speed, the next update of a chat is only posted once
+the bot has handled the previous one (the webhook answers after handling it, WEBHOOK_WAIT_HANDLED), and
+the bot runs without the behaviors that depend on the timing of the updates: the coalescing of the live
+location edits (LOCATION_COALESCING=0) and the radar cool-down (RADAR_COOLDOWN=0).
+
+The results can be saved and compared with those of a previous run, e.g. of another version of the bot
+given with --bot-dir, to spot throughput and latency regressions on real traffic.
+
+The database starts empty, so the recording should start with the bot, e.g. at the start of the event.
+
+Usage: python benchmark/replay.py updates.jsonl.gz --speed 0 --save new.json --baseline old.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+
+from fake_bot_api import FakeBotApi
+from load_test import APP_DIR, BotProcess, ThrowawayPostgres, _percentile
+
+sys.path.insert(0, APP_DIR)
+from UpdateRecorder import read_recording  # noqa: E402
+
+# Fields of the update holding the message, in the order they are checked
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+# Configuration of the bot answering the webhook once every update is handled, without the behaviors
+# that depend on the timing of the updates
+REPLAY_ENV = {'WEBHOOK_WAIT_HANDLED': '20', 'LOCATION_COALESCING': '0', 'RADAR_COOLDOWN': '0'}
+
+
+def _message(update):
+    for field in MESSAGE_FIELDS:
+        if field in update:
+            return update[field]
+    return update.get('callback_query', {}).get('message')
+
+
+def chat_id_of(update):
+    """
+    Id of the chat of an update, or None if it has none
+    """
+    message = _message(update)
+    return message['chat']['id'] if message else None
+
+
+def kind_of(update):
+    """
+    Kind of update the latencies are grouped by
+    """
+    if 'callback_query' in update:
+        return 'callback'
+    if 'edited_message' in update:
+        return 'location_edit' if 'location' in update['edited_message'] else 'edit'
+    message = update.get('message')
+    if not message:
+        return 'other'
+    if 'location' in message:
+        return 'location'
+    if message.get('text', '').startswith('/'):
+        return 'command'
+    return 'text' if 'text' in message else 'other'
+
+
+def shift_dates(value, offset):
+    """
+    Add offset seconds to every date and edit_date field of the update, in place
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ('date', 'edit_date') and isinstance(item, int):
+                value[key] = item + offset
+            else:
+                shift_dates(item, offset)
+    elif isinstance(value, list):
+        for item in value:
+            shift_dates(item, offset)
+
+
+class Posted:
+    """
+    Update posted to the bot
+    """
+    __slots__ = ('kind', 'chat_id', 'cursor', 'time')
+
+    def __init__(self, kind, chat_id, cursor, time):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.cursor = cursor
+        self.time = time
+
+
+def replay(recording, bot, api, speed):
+    """
+    Post the recorded updates to the bot. The updates of every chat are posted in order by a thread of
+    the chat, each one once the bot has handled the previous one, so the chats progress concurrently
+    while each of them goes through the same states on every run
+
+    :param speed: Factor applied to the original pace of the updates, 0 to post them as fast as possible
+    :return: (list of Posted by time, number of updates rejected by the bot, seconds the replay fell behind the pace at most)
+    """
+    by_chat = {}
+    for arrival, update in recording:
+        by_chat.setdefault(chat_id_of(update), []).append((arrival, update))
+    if not by_chat:
+        return [], 0, 0
+
+    first_arrival = min(entries[0][0] for entries in by_chat.values())
+    started = time.monotonic()
+    lock = threading.Lock()
+    posted = []
+    totals = {'failed': 0, 'max_lag': 0}
+
+    def post_chat(chat_id, entries):
+        for arrival, update in entries:
+            if speed:
+                delay = started + (arrival - first_arrival) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    with lock:
+                        totals['max_lag'] = max(totals['max_lag'], -delay)
+
+            shift_dates(update, int(time.time() - arrival))
+            cursor = api.cursor(chat_id) if chat_id is not None else 0
+            now = time.monotonic()
+            try:
+                # The bot answers once the update is handled
+                bot.post(update)
+            except (urllib.error.URLError, ConnectionError):
+                with lock:
+                    totals['failed'] += 1
+                continue
+            with lock:
+                posted.append(Posted(kind_of(update), chat_id, cursor, now))
+
+    threads = [threading.Thread(target=post_chat, args=item, daemon=True) for item in by_chat.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    posted.sort(key=lambda entry: entry.time)
+    return posted, totals['failed'], totals['max_lag']
+
+
+def wait_until_quiet(api, chat_ids, quiet, timeout):
+    """
+    Wait until the bot made no calls to the chats for quiet seconds
+    """
+    deadline = time.monotonic() + timeout
+    last = None
+    last_change = time.monotonic()
+    while time.monotonic() < deadline:
+        current = sum(api.cursor(chat_id) for chat_id in chat_ids)
+        if current != last:
+            last, last_change = current, time.monotonic()
+        elif time.monotonic() - last_change >= quiet:
+            return
+        time.sleep(0.2)
+
+
+def measure(posted, api):
+    """
+    Latency in seconds of every replied update by kind, and number of updates without reply by kind.
+    The reply of an update is the first call to its chat made before the next update of the chat was posted.
+    """
+    latencies, unanswered = {}, {}
+    by_chat = {}
+    for entry in posted:
+        if entry.chat_id is not None:
+            by_chat.setdefault(entry.chat_id, []).append(entry)
+
+    for chat_id, entries in by_chat.items():
+        sent = api.sent(chat_id)
+        for index, entry in enumerate(entries):
+            end = entries[index + 1].cursor if index + 1 < len(entries) else len(sent)
+            replies = sent[entry.cursor:end]
+            if replies:
+                latencies.setdefault(entry.kind, []).append(replies[0].time - entry.time)
+            else:
+                unanswered[entry.kind] = unanswered.get(entry.kind, 0) + 1
+    return latencies, unanswered
+
+
+def summarize(posted, failed, elapsed, latencies, unanswered):
+    """
+    Results of a replay as a JSON serializable dict
+    """
+    kinds = {}
+    for kind in sorted(set(latencies) | set(unanswered)):
+        values = sorted(latencies.get(kind, []))
+        kinds[kind] = {'replied': len(values), 'unanswered': unanswered.get(kind, 0)}
+        if values:
+            kinds[kind].update({f'p{p}_ms': round(_percentile(values, p) * 1000, 1) for p in (50, 95, 99)},
+                               max_ms=round(values[-1] * 1000, 1))
+    return {'updates': len(posted), 'failed': failed, 'elapsed_s': round(elapsed, 2),
+            'updates_per_s': round(len(posted) / elapsed, 1) if elapsed else 0, 'kinds': kinds}
+
+
+def report(summary):
+    print(f'\n{summary["updates"]} updates replayed in {summary["elapsed_s"]:.1f} s '
+          f'({summary["updates_per_s"]:.1f} updates/s), {summary["failed"]} rejected\n')
+    print(f'{"update":<16}{"replied":>8}{"no reply":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for kind, stats in summary['kinds'].items():
+        values = ''.join(f'{stats[key]:>10.1f}' if key in stats else f'{"-":>10}' for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'))
+        print(f'{kind:<16}{stats["replied"]:>8}{stats["unanswered"]:>10}{values}')
+
+
+def compare(summary, baseline, tolerance):
+    """
+    Print the changes from the baseline results and return the regressions beyond the tolerance
+    """
+    regressions = []
+
+    def check(name, before, after, higher_is_better=False):
+        if not before:
+            return
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<28}{before:>10.1f}{after:>10.1f}{change * 100:>+9.1f}%{flag}')
+
+    print(f'\n{"compared to baseline":<28}{"before":>10}{"after":>10}{"change":>10}')
+    check('updates/s', baseline['updates_per_s'], summary['updates_per_s'], higher_is_better=True)
+    for kind, stats in summary['kinds'].items():
+        previous = baseline['kinds'].get(kind, {})
+        for key in ('p50_ms', 'p95_ms'):
+            if key in stats and key in previous:
+                check(f'{kind} {key}', previous[key], stats[key])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay of recorded updates against the bot')
+    parser.add_argument('recording', help='Recording written by the bot with UPDATE_RECORDING')
+    parser.add_argument('--speed', type=float, default=1.0, help='Factor applied to the original pace, 0 for as fast as possible')
+    parser.add_argument('--bot-dir', default=APP_DIR, help='Directory of the version of the bot to run')
+    parser.add_argument('--save', help='File to save the results to, as JSON')
+    parser.add_argument('--baseline', help='Results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative worsening reported as a regression')
+    parser.add_argument('--quiet', type=float, default=3.0, help='Seconds without calls of the bot to consider the replay finished')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Maximum seconds to wait for the bot after the last update')
+    parser.add_argument('--external-db', action='store_true', help='Use the POSTGRES_* environment variables instead of a throwaway container')
+    parser.add_argument('--bot-log', default=os.devnull, help='File to write the output of the bot to')
+    options = parser.parse_args()
+
+    api = FakeBotApi()
+    api.start()
+    database = None if options.external_db else ThrowawayPostgres()
+    bot = None
+    try:
+        if database:
+            database.start()
+        bot = BotProcess(dict(database.env if database else {}, TELEGRAM_API_URL=api.base_url, **REPLAY_ENV), options.bot_log, options.bot_dir)
+        print(f'Bot ready in {bot.start():.2f} s')
+
+        started = time.monotonic()
+        posted, failed, max_lag = replay(read_recording(options.recording), bot, api, options.speed)
+        wait_until_quiet(api, {entry.chat_id for entry in posted if entry.chat_id is not None}, options.quiet, options.timeout)
+        # The quiet period after the last reply is not part of the replay
+        last_reply = max((sent.time for chat_id in {entry.chat_id for entry in posted if entry.chat_id is not None}
+                          for sent in api.sent(chat_id)), default=time.monotonic())
+        elapsed = max(last_reply, posted[-1].time if posted else started) - started
+
+        latencies, unanswered = measure(posted, api)
+        summary = summarize(posted, failed, elapsed, latencies, unanswered)
+        report(summary)
+        if options.speed and max_lag > 1:
+            print(f'\nThe replay fell up to {max_lag:.1f} s behind the recorded pace')
+    finally:
+        if bot:
+            bot.stop()
+        if database:
+            database.stop()
+        api.stop()
+
+    if options.save:
+        with open(options.save, 'w') as results_file:
+            json.dump(summary, results_file, indent=2)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compare(summary, json.load(baseline_file), options.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
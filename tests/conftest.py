@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the bot are imported by name from the app directory, as the bot itself does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
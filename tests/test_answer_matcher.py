@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from AnswerMatcher import AnswerMatcher, bounded_distance, normalize
+
+
+def levenshtein(first, second):
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+def test_normalize_ignores_accents_case_punctuation_and_whitespace():
+    assert normalize('  ¡Camino  de la FUENSANTA!  ') == 'camino de la fuensanta'
+    assert normalize('Alcalá-de_Henares') == 'alcala de henares'
+    assert normalize('Ñandú') == 'nandu'
+
+
+@pytest.mark.parametrize('limit', [0, 1, 2, 3])
+def test_bounded_distance_matches_levenshtein_up_to_the_limit(limit):
+    rng = random.Random(limit)
+    for _ in range(500):
+        first = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 8)))
+        second = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 8)))
+        assert bounded_distance(first, second, limit) == min(levenshtein(first, second), limit + 1)
+
+
+def test_matches_alternative_answers_such_as_numerals():
+    matcher = AnswerMatcher.from_question({'id': 1, 'answer': 'XV', 'answers': ['15']})
+    assert matcher.matches('xv')
+    assert matcher.matches(' 15. ')
+    assert not matcher.matches('16')
+
+
+def test_typos_are_only_tolerated_when_configured():
+    strict = AnswerMatcher.from_question({'id': 1, 'answer': 'Camino de la Fuensanta'})
+    tolerant = AnswerMatcher.from_question({'id': 2, 'answer': 'Camino de la Fuensanta', 'max_typos': 2})
+    assert strict.matches('camino de la fuensanta')
+    assert not strict.matches('camino de la fuensata')
+    assert tolerant.matches('camino de la fuensata')
+    assert tolerant.matches('camno de la fuensata')
+    assert not tolerant.matches('camno de la funsata')
+
+
+def test_question_without_answer_has_no_matcher():
+    assert AnswerMatcher.from_question({'id': 1}) is None
+    assert AnswerMatcher.from_question({'id': 1, 'answer': '¿?'}) is None
+
+
+def test_negative_max_typos_is_rejected():
+    with pytest.raises(ValueError):
+        AnswerMatcher.from_question({'id': 1, 'answer': 'a', 'max_typos': -1})
@@ -0,0 +1,75 @@
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+from Database import Database
+
+
+class FakeConnection:
+    def __init__(self, rollback_error=None):
+        self.closed = 0
+        self.rollback_error = rollback_error
+        self.rollbacks = 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+        if self.rollback_error:
+            raise self.rollback_error
+
+
+class FakePool:
+    """
+    Pool handing out a single connection and recording whether it was closed when returned
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed_on_return = None
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn, close=False):
+        self.closed_on_return = close
+
+
+def database_with(conn):
+    database = Database(1, 1)
+    database._pool = FakePool(conn)
+    return database
+
+
+@pytest.mark.parametrize('error', [psycopg2.extensions.TransactionRollbackError('deadlock detected'),
+                                   psycopg2.extensions.QueryCanceledError('canceling statement due to statement timeout'),
+                                   ValueError('error of the handler')])
+def test_errors_leaving_the_connection_usable_keep_it(error):
+    conn = FakeConnection()
+    database = database_with(conn)
+    with pytest.raises(type(error)):
+        with database.transaction():
+            raise error
+    assert conn.rollbacks == 1
+    assert database._pool.closed_on_return is False
+
+
+def test_closed_connection_is_discarded():
+    conn = FakeConnection()
+    database = database_with(conn)
+    with pytest.raises(psycopg2.OperationalError):
+        with database.transaction():
+            conn.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+    assert conn.rollbacks == 0
+    assert database._pool.closed_on_return is True
+
+
+def test_connection_failing_to_roll_back_is_discarded():
+    conn = FakeConnection(rollback_error=psycopg2.InterfaceError('connection already closed'))
+    database = database_with(conn)
+    with pytest.raises(psycopg2.OperationalError):
+        with database.transaction():
+            raise psycopg2.OperationalError('SSL connection has been closed unexpectedly')
+    assert database._pool.closed_on_return is True
@@ -0,0 +1,27 @@
+import hashlib
+import os
+
+import pytest
+
+from FileHasher import FileHasher
+
+
+def test_hash_is_recomputed_only_when_the_file_changes(tmp_path):
+    path = tmp_path / 'image.png'
+    path.write_bytes(b'first')
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    hasher = FileHasher()
+    assert hasher.content_hash(str(path)) == hashlib.sha256(b'first').hexdigest()
+
+    # Same mtime and size: the cached hash is served without reading the file
+    path.write_bytes(b'other')
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    assert hasher.content_hash(str(path)) == hashlib.sha256(b'first').hexdigest()
+
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    assert hasher.content_hash(str(path)) == hashlib.sha256(b'other').hexdigest()
+
+
+def test_missing_file_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        FileHasher().content_hash(str(tmp_path / 'missing.png'))
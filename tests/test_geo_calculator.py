@@ -0,0 +1,59 @@
+import math
+import random
+
+import pytest
+
+from GeoCalculator import RADIUS, GeoCalculator
+
+TARGET = (37.3331, -5.8493)
+
+
+def random_coordinates(rng, count):
+    return [(TARGET[0] + rng.uniform(-0.05, 0.05), TARGET[1] + rng.uniform(-0.05, 0.05)) for _ in range(count)]
+
+
+def scalar_navigation(coord, target):
+    bearing = GeoCalculator.calculate_compass_bearing(coord, target)
+    return GeoCalculator.calculate_distance(coord, target), bearing, GeoCalculator.convert_bearing_to_cardinal(bearing)
+
+
+def assert_matches_scalar(results, pairs):
+    distances, bearings, cardinals = results
+    assert len(distances) == len(bearings) == len(cardinals) == len(pairs)
+    for distance, bearing, cardinal, (coord, target) in zip(distances, bearings, cardinals, pairs):
+        expected_distance, expected_bearing, expected_cardinal = scalar_navigation(coord, target)
+        assert distance == pytest.approx(expected_distance, abs=1e-9)
+        assert (bearing, cardinal) == (expected_bearing, expected_cardinal)
+
+
+def test_many_to_one_matches_the_scalar_functions():
+    coords = random_coordinates(random.Random(1), 200)
+    assert_matches_scalar(GeoCalculator.calculate_navigation(coords, TARGET), [(coord, TARGET) for coord in coords])
+
+
+def test_one_to_many_matches_the_scalar_functions():
+    targets = random_coordinates(random.Random(2), 200)
+    assert_matches_scalar(GeoCalculator.calculate_navigation(TARGET, targets), [(TARGET, target) for target in targets])
+
+
+def test_pairs_match_the_scalar_functions():
+    rng = random.Random(3)
+    coords, targets = random_coordinates(rng, 200), random_coordinates(rng, 200)
+    assert_matches_scalar(GeoCalculator.calculate_navigation(coords, targets), list(zip(coords, targets)))
+
+
+def test_single_pair_and_same_point():
+    assert_matches_scalar(GeoCalculator.calculate_navigation(list(TARGET), (37.34, -5.85)), [(TARGET, (37.34, -5.85))])
+    assert GeoCalculator.calculate_navigation(TARGET, TARGET) == ([0.0], [0], ['Norte'])
+
+
+def test_pairs_of_different_length_are_rejected():
+    with pytest.raises(ValueError):
+        GeoCalculator.calculate_navigation([TARGET, TARGET], [TARGET])
+
+
+def test_haversine_agrees_with_the_distance_and_thresholds():
+    for coord in random_coordinates(random.Random(4), 200):
+        haversine = GeoCalculator.calculate_haversine(coord, TARGET)
+        assert 2 * RADIUS * math.asin(math.sqrt(haversine)) == pytest.approx(GeoCalculator.calculate_distance(coord, TARGET), abs=1e-9)
+    assert GeoCalculator.haversine_threshold(1.0) == pytest.approx(GeoCalculator.calculate_haversine((0, 0), (1 / (RADIUS * math.pi / 180), 0)))
@@ -0,0 +1,68 @@
+from Geofence import GeofenceEngine, KM_PER_DEGREE
+
+TARGET = (40.48, -3.36)
+RADIUS = 0.01
+
+
+def north(meters):
+    """
+    Position the given meters north of the target
+    """
+    return TARGET[0] + meters / 1000 / KM_PER_DEGREE, TARGET[1]
+
+
+def engine(**kwargs):
+    loads = []
+
+    def load_target(chat_id):
+        loads.append(chat_id)
+        return TARGET
+
+    return GeofenceEngine(load_target, RADIUS, **kwargs), loads
+
+
+def test_arrival_needs_consecutive_confirmations():
+    geofences, _ = engine(confirmations=2)
+    assert not geofences.check(1, *north(5))
+    assert geofences.check(1, *north(5))
+
+
+def test_leaving_beyond_the_exit_radius_resets_the_confirmations():
+    geofences, _ = engine(confirmations=2, exit_factor=1.5)
+    assert not geofences.check(1, *north(5))
+    assert not geofences.check(1, *north(20))
+    assert not geofences.check(1, *north(5))
+    assert geofences.check(1, *north(5))
+
+
+def test_jitter_between_the_radii_keeps_the_confirmations():
+    geofences, _ = engine(confirmations=2, exit_factor=1.5)
+    assert not geofences.check(1, *north(5))
+    assert not geofences.check(1, *north(12))
+    assert geofences.check(1, *north(5))
+
+
+def test_inaccurate_readings_are_ignored():
+    geofences, _ = engine(confirmations=1, max_accuracy=50)
+    assert not geofences.check(1, *north(0), accuracy=100)
+    assert geofences.check(1, *north(0), accuracy=10)
+
+
+def test_fires_once_until_invalidated():
+    geofences, loads = engine(confirmations=1)
+    assert geofences.check(1, *north(0))
+    assert not geofences.check(1, *north(0))
+    geofences.invalidate(1)
+    assert geofences.check(1, *north(0))
+    assert loads == [1, 1]
+
+
+def test_disarmed_chat_does_not_fire():
+    geofences, _ = engine(confirmations=1)
+    geofences.disarm(1)
+    assert not geofences.check(1, *north(0))
+
+
+def test_chat_without_target_never_fires():
+    geofences = GeofenceEngine(lambda chat_id: None, RADIUS, confirmations=1)
+    assert not geofences.check(1, *north(0))
@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+
+from Leaderboard import Leaderboard
+
+
+class FakeDatabase:
+    """
+    Database answering the load of the top with the given rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.loads = 0
+
+    @contextmanager
+    def cursor(self):
+        database = self
+
+        class Cursor:
+            def execute(self, query, params=None):
+                database.loads += 1
+                self.limit = params[-1]
+
+            def fetchall(self):
+                return sorted(database.rows)[:self.limit]
+
+        yield Cursor()
+
+
+def test_finish_is_placed_in_the_top_without_reloading():
+    database = FakeDatabase([(30, 1, 'a'), (10, 2, 'b')])
+    leaderboard = Leaderboard(database, 'alcala', size=3)
+    assert leaderboard.top() == [(10, 2, 'b'), (30, 1, 'a')]
+    leaderboard.on_finish(3, 'c', 20)
+    assert leaderboard.top() == [(10, 2, 'b'), (20, 3, 'c'), (30, 1, 'a')]
+    assert database.loads == 1
+
+
+def test_full_top_keeps_the_best_times():
+    database = FakeDatabase([(10, 1, 'a'), (20, 2, 'b')])
+    leaderboard = Leaderboard(database, 'alcala', size=2)
+    leaderboard.top()
+    leaderboard.on_finish(3, 'c', 30)
+    assert leaderboard.top() == [(10, 1, 'a'), (20, 2, 'b')]
+    leaderboard.on_finish(4, 'd', 15)
+    assert leaderboard.top() == [(10, 1, 'a'), (15, 4, 'd')]
+    assert database.loads == 1
+
+
+def test_chat_leaving_a_full_top_reloads_it():
+    database = FakeDatabase([(10, 1, 'a'), (20, 2, 'b'), (30, 3, 'c')])
+    leaderboard = Leaderboard(database, 'alcala', size=2)
+    leaderboard.top()
+    database.rows = [(10, 1, 'a'), (40, 2, 'b'), (30, 3, 'c')]
+    leaderboard.on_finish(2, 'b', 40)
+    assert leaderboard.top() == [(10, 1, 'a'), (30, 3, 'c')]
+    assert database.loads == 2
+
+
+def test_restart_of_a_chat_in_the_top_reloads_it():
+    database = FakeDatabase([(10, 1, 'a'), (20, 2, 'b')])
+    leaderboard = Leaderboard(database, 'alcala', size=5)
+    leaderboard.top()
+    leaderboard.on_restart(3)
+    leaderboard.top()
+    assert database.loads == 1
+    database.rows = [(20, 2, 'b')]
+    leaderboard.on_restart(1)
+    assert leaderboard.top() == [(20, 2, 'b')]
+    assert database.loads == 2
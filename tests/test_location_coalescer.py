@@ -0,0 +1,98 @@
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import DispatcherHandlerStop
+
+from LocationCoalescer import LocationCoalescer
+
+
+class ManualExecutor:
+    """
+    Executor running the queued tasks only when asked, with a bounded queue
+    """
+
+    def __init__(self, capacity=10):
+        self.capacity = capacity
+        self.tasks = []
+
+    def submit(self, chat_id, handler, *args, block=True, **kwargs):
+        if len(self.tasks) >= self.capacity:
+            return False
+        self.tasks.append((handler, args, kwargs))
+        return True
+
+    def run(self):
+        tasks, self.tasks = self.tasks, []
+        for handler, args, kwargs in tasks:
+            handler(*args, **kwargs)
+
+
+def edit(chat_id, latitude, age=0):
+    message = SimpleNamespace(edit_date=datetime.fromtimestamp(time.time() - age), location=SimpleNamespace(latitude=latitude))
+    return SimpleNamespace(edited_message=message, effective_chat=SimpleNamespace(id=chat_id))
+
+
+def coalescer(executor, max_age=60):
+    handled, counters = [], {'coalesced': 0, 'shed': 0}
+
+    def on(name):
+        return lambda: counters.__setitem__(name, counters[name] + 1)
+
+    instance = LocationCoalescer(executor, lambda update, context: handled.append(update.edited_message.location.latitude),
+                                 max_age, on_coalesced=on('coalesced'), on_shed=on('shed'))
+    return instance, handled, counters
+
+
+def test_only_the_newest_edit_of_a_chat_is_processed():
+    executor = ManualExecutor()
+    locations, handled, counters = coalescer(executor)
+    for latitude in (1, 2, 3):
+        locations.offer(1, edit(1, latitude), None)
+    locations.offer(2, edit(2, 10), None)
+    assert len(executor.tasks) == 2
+    executor.run()
+    assert handled == [3, 10]
+    assert counters == {'coalesced': 2, 'shed': 0}
+
+
+def test_edit_after_processing_is_scheduled_again():
+    executor = ManualExecutor()
+    locations, handled, _ = coalescer(executor)
+    locations.offer(1, edit(1, 1), None)
+    executor.run()
+    locations.offer(1, edit(1, 2), None)
+    executor.run()
+    assert handled == [1, 2]
+
+
+def test_edits_are_shed_when_the_queue_is_full():
+    executor = ManualExecutor(capacity=1)
+    locations, handled, counters = coalescer(executor)
+    locations.offer(1, edit(1, 1), None)
+    locations.offer(2, edit(2, 2), None)
+    executor.run()
+    assert handled == [1]
+    assert counters['shed'] == 1
+    # The shed chat is not left as scheduled
+    locations.offer(2, edit(2, 3), None)
+    executor.run()
+    assert handled == [1, 3]
+
+
+def test_stale_edits_are_dropped():
+    executor = ManualExecutor()
+    locations, handled, counters = coalescer(executor, max_age=60)
+    locations.offer(1, edit(1, 1, age=120), None)
+    executor.run()
+    assert handled == []
+    assert counters['shed'] == 1
+
+
+def test_handle_stops_the_other_handlers():
+    executor = ManualExecutor()
+    locations, _, _ = coalescer(executor)
+    with pytest.raises(DispatcherHandlerStop):
+        locations.handle(edit(1, 1), None)
+    assert len(executor.tasks) == 1
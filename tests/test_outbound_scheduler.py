@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+from telegram.error import BadRequest, NetworkError
+
+from OutboundScheduler import OutboundScheduler
+
+
+def test_global_rate_holds_from_the_first_second():
+    scheduler = OutboundScheduler(rate=20, chat_rate=100, chat_burst=100, burst=1)
+    sent = []
+    started = time.monotonic()
+
+    def sender(chat_id):
+        for _ in range(10):
+            scheduler.send(chat_id, lambda: sent.append(time.monotonic() - started))
+
+    threads = [threading.Thread(target=sender, args=(chat_id,)) for chat_id in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(1 for elapsed in sent if elapsed < 1) <= 21
+
+
+def test_chat_burst_then_chat_rate():
+    scheduler = OutboundScheduler(rate=1000, chat_rate=10, chat_burst=3, burst=1000)
+    started = time.monotonic()
+    for _ in range(3):
+        scheduler.acquire(1)
+    assert time.monotonic() - started < 0.05
+    scheduler.acquire(1)
+    assert time.monotonic() - started >= 0.08
+
+
+def test_bad_requests_are_not_retried():
+    scheduler = OutboundScheduler(backoff=0.5)
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise BadRequest('Wrong file identifier')
+
+    with pytest.raises(BadRequest):
+        scheduler.send(1, call)
+    assert len(calls) == 1
+
+
+def test_network_errors_are_retried():
+    scheduler = OutboundScheduler(backoff=0.01)
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) < 3:
+            raise NetworkError('Connection reset')
+        return 'sent'
+
+    assert scheduler.send(1, call) == 'sent'
+    assert len(calls) == 3
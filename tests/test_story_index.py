@@ -0,0 +1,53 @@
+import json
+import os
+
+import pytest
+
+from StoryIndex import StoryIndex
+
+
+def write_history(path, steps, mtime):
+    path.write_text(json.dumps([{'id': step, 'questions': [{'id': 0, 'answer': f'respuesta {step}'}]} for step in steps]))
+    # Explicit modification times, so the changes are seen even within the resolution of the file system
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_reloads_when_the_file_changes(tmp_path):
+    path = tmp_path / 'history.json'
+    write_history(path, [0, 1], 1_000_000_000)
+    index = StoryIndex(str(path))
+    assert index.get_last_step() == 1
+
+    write_history(path, [0, 1, 2], 2_000_000_000)
+    assert index.get_last_step() == 2
+    assert index.get_question(2, 0)['answer'] == 'respuesta 2'
+    assert index.get_matcher(2, 0).matches('Respuesta 2')
+
+
+def test_keeps_the_last_good_index_when_the_file_breaks(tmp_path):
+    path = tmp_path / 'history.json'
+    write_history(path, [0, 1], 1_000_000_000)
+    index = StoryIndex(str(path))
+
+    path.write_text('[{"id": 0, ')
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    assert index.get_last_step() == 1
+    assert index.get_step(1) is not None
+
+    path.unlink()
+    assert index.get_last_step() == 1
+
+    write_history(path, [0, 1, 2, 3], 3_000_000_000)
+    assert index.get_last_step() == 3
+
+
+def test_missing_file_at_startup_fails(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        StoryIndex(str(tmp_path / 'missing.json'))
+
+
+def test_invalid_file_at_startup_fails(tmp_path):
+    path = tmp_path / 'history.json'
+    path.write_text('[]')
+    with pytest.raises(ValueError):
+        StoryIndex(str(path))
@@ -0,0 +1,47 @@
+from OutboundScheduler import OutboundScheduler
+from TelegramRequest import InstrumentedRequest
+
+
+class RecordingRequest(InstrumentedRequest):
+    """
+    Request recording the calls instead of posting them to the Bot API
+    """
+
+    def __init__(self, posted, defer):
+        super().__init__(lambda *args: None, scheduler=OutboundScheduler(rate=1000, chat_burst=100), defer=defer)
+        self.posted = posted
+
+    def _post(self, method, url, data, timeout):
+        self.posted.append((method, data.get('text')))
+        return {'message_id': len(self.posted)}
+
+
+def request_with(defer):
+    posted = []
+    return RecordingRequest(posted, defer), posted
+
+
+def test_messages_are_deferred_while_the_defer_callable_accepts_them():
+    deferred = []
+    request, posted = request_with(lambda send: deferred.append(send) or True)
+
+    assert request.post('https://api/bot/sendMessage', {'chat_id': 1, 'text': 'a'}) is True
+    assert request.post('https://api/bot/editMessageText', {'chat_id': 1, 'text': 'b'}) is True
+    assert posted == []
+
+    for send in deferred:
+        send()
+    assert posted == [('sendMessage', 'a'), ('editMessageText', 'b')]
+
+
+def test_messages_are_sent_right_away_when_not_deferred():
+    request, posted = request_with(lambda send: False)
+    assert request.post('https://api/bot/sendMessage', {'chat_id': 1, 'text': 'a'}) == {'message_id': 1}
+    assert posted == [('sendMessage', 'a')]
+
+
+def test_calls_without_chat_are_never_deferred():
+    deferred = []
+    request, posted = request_with(lambda send: deferred.append(send) or True)
+    assert request.post('https://api/bot/getMe', {}) == {'message_id': 1}
+    assert posted == [('getMe', None)] and deferred == []